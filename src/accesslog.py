@@ -0,0 +1,106 @@
+import logging
+import threading
+import time
+import random
+from collections import deque
+
+class AccessLog(object):
+    '''query log that stays off the serving path.
+
+record() only counts the query and, for the sampled fraction of
+queries, appends an entry to a bounded ring buffer; a background
+thread writes the buffered entries out in batches and logs the counters
+collected in each interval.  When the buffer is full the oldest entries
+are dropped (and counted).  Counting is safe from any number of
+threads.'''
+    # batch counts MULTI requests, their numbers are counted by status;
+    # limited counts requests refused by the rate limiter
+    statuses = ('hit', 'miss', 'malformed', 'error', 'batch', 'limited')
+
+    def __init__(self, logger=None, sample_rate=1.0, buffer_size=10000,
+            flush_interval=1.0, stats_interval=60):
+        if logger is None:
+            self.log = logging.getLogger('access')
+        else:
+            self.log = logger
+        self.sample_rate = sample_rate
+        self.buffer = deque(maxlen=buffer_size)
+        self.flush_interval = flush_interval
+        self.stats_interval = stats_interval
+        self.counts = self._new_counts()
+        # guards counts, += on a dict item is not atomic
+        self.lock = threading.Lock()
+        # a RateLimiter, its untracked and pruned counts are reported too
+        self.limiter = None
+        self.limiter_seen = {}
+        self.running = False
+        self.thread = None
+
+    def _new_counts(self):
+        d = dict.fromkeys(self.statuses, 0)
+        d['dropped'] = 0
+        return d
+
+    def count(self, status, n=1):
+        with self.lock:
+            self.counts[status] += n
+
+    def record(self, address, query, status, elapsed):
+        sampled = self.sample_rate >= 1.0 or \
+                random.random() < self.sample_rate
+        with self.lock:
+            self.counts[status] += 1
+            if sampled and len(self.buffer) == self.buffer.maxlen:
+                self.counts['dropped'] += 1
+        if sampled:
+            self.buffer.append((address, query, status, elapsed))
+
+    def flush(self):
+        buf = self.buffer
+        while True:
+            try:
+                address, query, status, elapsed = buf.popleft()
+            except IndexError:
+                break
+            self.log.info("%s - QUERY %s %s in %.6f s", address, query,
+                    status, elapsed)
+
+    def report(self):
+        with self.lock:
+            counts, self.counts = self.counts, self._new_counts()
+        names = self.statuses + ('dropped',)
+        if self.limiter is not None:
+            # the limiter's counts only grow, report what came since
+            # the last time
+            for k in ('untracked', 'pruned'):
+                total = self.limiter.counts[k]
+                counts[k] = total - self.limiter_seen.get(k, 0)
+                self.limiter_seen[k] = total
+            names += ('untracked', 'pruned')
+        self.log.info("%s", ', '.join('%s %s' % (k, counts[k])
+                for k in names))
+        return counts
+
+    def _run(self):
+        last = time.time()
+        while self.running:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+                if self.stats_interval > 0 and \
+                        time.time() - last >= self.stats_interval:
+                    last = time.time()
+                    self.report()
+            except:
+                self.log.exception("access log writer failed")
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.flush()
+        self.report()
@@ -2,6 +2,7 @@ import csv
 import logging
 import binascii
 import datetime
+import hashlib
 from M2Crypto import DSA, BIO, EVP
 try:
     from cStringIO import StringIO
@@ -34,15 +35,21 @@ def make_csv_record(start, end, sip, owner, mdate):
         writer.writerow([start, end, sip, owner, mdate])
     return f.getvalue().strip()
 
-def sign_record(dsa, start, end, sip, owner, mdate):
-    return sign_csv_record(dsa, make_csv_record(start, end, sip, owner, mdate))
+def sign_record(dsa, start, end, sip, owner, mdate, keyid=None):
+    return sign_csv_record(dsa, make_csv_record(start, end, sip, owner, mdate),
+            keyid)
 
-def sign_csv_record(dsa, msg):
+def sign_csv_record(dsa, msg, keyid=None):
+    '''keyid: key_id of the public key, appended to the signature so
+verifiers know which key to use'''
     md = EVP.MessageDigest('sha1')
     md.update(msg)
     digest = md.final()
     r, s = dsa.sign(digest)
-    return '%s %s'%(r.encode('base64').strip(), s.encode('base64').strip())
+    sig = '%s %s'%(r.encode('base64').strip(), s.encode('base64').strip())
+    if keyid:
+        sig += ' ' + keyid
+    return sig
 
 def check_signature(dsapub, sig, start, end, sip, owner, mdate, *args):
     return check_csv_signature(dsapub, sig,
@@ -53,9 +60,12 @@ def check_csv_signature(dsapub, sig, msg):
     md.update(msg)
     digest = md.final()
     try:
-        r, s = sig.split()
-        r = r.decode('base64')
-        s = s.decode('base64')
+        parts = sig.split()
+        # a third part is the key id
+        if len(parts) not in (2, 3):
+            raise ValueError
+        r = parts[0].decode('base64')
+        s = parts[1].decode('base64')
     except (ValueError, binascii.Error):
         logging.warn('invalid signature: %s', sig)
         return False
@@ -69,6 +79,53 @@ def parse_pub_key(pubstr):
     mem = BIO.MemoryBuffer(pubstr)
     return DSA.load_pub_key_bio(mem)
 
+# parsed public keys by (owner, sha1 of the PEM), shared by everything
+# checking signatures in the process
+_pub_keys = {}
+
+def cached_pub_key(owner, pubstr):
+    '''parse_pub_key, parsing every key only once per process'''
+    if isinstance(pubstr, unicode):
+        pubstr = pubstr.encode('ascii')
+    k = (owner, hashlib.sha1(pubstr).digest())
+    dsapub = _pub_keys.get(k)
+    if dsapub is None:
+        dsapub = _pub_keys[k] = parse_pub_key(pubstr)
+    return dsapub
+
+# key_id by PEM
+_key_ids = {}
+
+def key_id(pubstr):
+    '''short fingerprint of a PEM public key, only the base64 lines count
+so line endings don't matter'''
+    keyid = _key_ids.get(pubstr)
+    if keyid is None:
+        body = ''.join(line.strip() for line in pubstr.splitlines()
+                if not line.startswith('-----'))
+        keyid = _key_ids[pubstr] = hashlib.sha1(body).hexdigest()[:8]
+    return keyid
+
+def dsa_key_id(dsa):
+    '''key_id of the public half of dsa'''
+    pub = BIO.MemoryBuffer()
+    dsa.save_pub_key_bio(pub)
+    return key_id(pub.read())
+
+def signature_keys(sig, pubstrs):
+    '''the keys among pubstrs to check sig with: the one it names, all of
+them for signatures made without a key id'''
+    parts = sig.split()
+    if len(parts) != 3:
+        return list(pubstrs)
+    return [k for k in pubstrs if key_id(k) == parts[2]]
+
+def forget_pub_keys(owner=None):
+    '''drops the cached keys of owner, of everyone if None'''
+    for k in _pub_keys.keys():
+        if owner is None or k[0] == owner:
+            _pub_keys.pop(k, None)
+
 def parse_priv_key(privstr):
     if not isinstance(privstr, str):
         raise TypeError('str argument required')
@@ -4,19 +4,130 @@ import sqlite3
 import os.path
 import logging
 import time
+import threading
+import functools
+from contextlib import contextmanager
 from datetime import datetime
+from collections import deque
 
 import crypto
+import prefixindex
+import sigbatch
 import utils
 
+class _Range(object):
+    '''a range as update_data plans its changes'''
+    def __init__(self, row, orig=None):
+        self.start, self.end, self.sip, self.owner, date, self.sig = row
+        self.date = utils.parse_datetime_iso(date)
+        self.s = int(self.start)
+        self.e = int(self.end)
+        # start in numbex_ranges, None for new ranges
+        self.orig = orig
+        self.dirty = orig is None
+
+    def row(self):
+        return [self.start, self.end, self.sip, self.owner, self.date,
+                self.sig]
+
+    def set(self, start, end, date, sig=''):
+        self.start, self.end = start, end
+        self.s, self.e = int(start), int(end)
+        self.date = utils.parse_datetime_iso(date)
+        self.sig = sig
+        self.dirty = True
+        assert self.s <= self.e
+
+
+class ConnectionPool(object):
+    '''sqlite connections to one database for the threads of a process.
+
+every thread gets a connection of its own for reading.  Writes go
+through the one writer connection, see write(), so writers of this
+process queue up on a lock instead of the sqlite file lock.  Files are
+switched to WAL, where readers see the last commit without waiting for
+a writer.  A ':memory:' database can't be shared between connections,
+it gets a single one for everything.
+
+timeout: seconds to wait for a lock held by another process'''
+    def __init__(self, filename, timeout=30):
+        self.filename = filename
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.RLock()
+        self.writer = None
+        if filename == ':memory:':
+            self.writer = self._connect(False)
+
+    def _connect(self, same_thread=True):
+        conn = sqlite3.connect(self.filename, timeout=self.timeout,
+                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES,
+                check_same_thread=same_thread)
+        if self.filename != ':memory:':
+            conn.execute('pragma journal_mode = wal')
+        return conn
+
+    def connection(self):
+        '''the connection of the calling thread, the writer while it holds
+write()'''
+        if self.filename == ':memory:' or getattr(self.local, 'writing', 0):
+            return self.writer
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self.local.conn = self._connect()
+        return conn
+
+    @contextmanager
+    def write(self):
+        '''holds the writer connection, may be nested'''
+        with self.lock:
+            if self.writer is None:
+                self.writer = self._connect(False)
+            self.local.writing = getattr(self.local, 'writing', 0) + 1
+            try:
+                yield self.writer
+            finally:
+                self.local.writing -= 1
+
+    def close(self):
+        '''closes the writer and the connection of the calling thread,
+those of other threads are closed with their threads'''
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+
+def _writes(method):
+    '''runs method on the writer connection of the pool'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.pool.write():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 class Database(object):
+    # number of change journal entries kept by clear_changed_data
+    journal_keep = 100000
+    # number of verified signatures remembered, see add_verified
+    verified_keep = 2000000
+
     def __init__(self, filename, logger=None, fill_example=None):
         if logger is None:
             self.log = logging.getLogger('database')
         else:
             self.log = logger
 
-        self.conn = None
+        self.pool = None
+        # digests found by get_verified, moved up by the next add_verified;
+        # shared by the threads
+        self._verified_used = set()
+        self._verified_lock = threading.Lock()
         self.log.info('starting database with file %s', filename)
 
         self.filename = filename
@@ -27,6 +138,8 @@ class Database(object):
                 fill_example = True
         else:
             self.connect(filename)
+            if filename != ':memory:':
+                self.upgrade_db()
 
         if fill_example:
             self._populate_example()
@@ -34,17 +147,31 @@ class Database(object):
     def connect(self, filename=None):
         if filename is None:
             filename = self.filename
-        self.conn = sqlite3.connect(filename,
-                detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+        self.pool = ConnectionPool(filename)
+
+    @property
+    def conn(self):
+        '''the connection for the calling thread'''
+        return self.pool.connection()
 
     def close(self):
-        if self.conn is not None:
-            self.conn.close()
-            self.conn = None
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
 
+    @_writes
     def commit(self):
+        '''commits the writes of insert_range and friends'''
         self.conn.commit()
 
+    def _writer_cursor(self, cursor):
+        '''cursor if it is on the writer, a new one there otherwise; call
+with the writer held'''
+        if cursor.connection is self.conn:
+            return cursor
+        return self.conn.cursor()
+
+    @_writes
     def create_db(self):
         self.log.info('creating database tables.')
         c = self.conn.cursor()
@@ -80,11 +207,54 @@ class Database(object):
             type char(1))''')
 
         c.close()
+        self.upgrade_db()
+
+    @_writes
+    def upgrade_db(self):
+        'creates tables missing in databases made by older versions'
+        c = self.conn.cursor()
+        # unlike numbex_range_changes this is not cleared on export,
+        # so readers can follow it to pick up incremental changes
+        c.execute('''create table if not exists numbex_range_journal (
+            seq integer primary key autoincrement,
+            start text,
+            end text)''')
+        # _e - _s of the longest range there ever was, bounds the seek on
+        # _s for ranges containing a number
+        c.execute('''create table if not exists numbex_meta (
+            name text primary key,
+            value)''')
+        # digests of records with valid signatures, see sigbatch; the
+        # rowid grows with every use, see add_verified
+        c.execute('''create table if not exists numbex_verified (
+            digest text primary key)''')
+        c.execute('''select 1 from numbex_meta where name = 'max_span' ''')
+        if not list(c):
+            c.execute('''insert into numbex_meta (name, value)
+                    values ('max_span', 0)''')
+            self._reset_max_span(c)
+        c.close()
         self.conn.commit()
 
+    def _reset_max_span(self, cursor):
+        '''recomputes max_span, which deleting or shrinking ranges never
+lowers'''
+        cursor.execute('''update numbex_meta
+                set value = (select coalesce(max(_e - _s), 0)
+                    from numbex_ranges)
+                where name = 'max_span' ''')
+
+    def _widen_max_span(self, cursor, span):
+        cursor.execute('''update numbex_meta set value = ?
+                where name = 'max_span' and value < ?''', [span, span])
+
+    @_writes
     def drop_db(self):
         self.log.info('dropping database tables.')
         c = self.conn.cursor()
+        c.execute('drop table numbex_verified')
+        c.execute('drop table numbex_meta')
+        c.execute('drop table numbex_range_journal')
         c.execute('drop table numbex_range_changes')
         c.execute('drop table numbex_ranges')
         c.execute('drop table numbex_pubkeys')
@@ -93,6 +263,7 @@ class Database(object):
         c.close()
         self.conn.commit()
 
+    @_writes
     def _populate_example(self):
         self.log.info('generating example data...')
         starttime = time.clock()
@@ -181,36 +352,54 @@ W7d77Yq4f2BRkGFp/2Jz
             assert isinstance(r[4], datetime)
             c.execute('''insert into numbex_ranges (start, end, sip, owner, date_changed, signature, _s, _e)
                 values (?, ?, ?, ?, ?, ?, ?, ?)''', (list(r)+[sig, int(r[0]), int(r[1])]))
+        self._reset_max_span(c)
         self.conn.commit()
 
-    def get_data_all(self):
+    def _iter_ranges(self, where, params, batch, raw_dates):
+        '''yields the rows of numbex_ranges matching where, fetching batch
+of them at a time.  raw_dates: leave date_changed an ISO 8601 string
+instead of making a datetime of it.
+
+the cursor stays open until the generator is exhausted or closed, don't
+commit on this connection in between'''
+        if raw_dates:
+            # an expression has no declared type, so nothing converts it
+            date = "replace(date_changed, ' ', 'T')"
+        else:
+            date = 'date_changed'
         c = self.conn.cursor()
-        c.execute('''select start, end, sip, owner, date_changed, signature
-                from numbex_ranges
-                order by start''')
-        result = list(c)
-        c.close()
-        return result
+        try:
+            c.execute('''select start, end, sip, owner, %s, signature
+                    from numbex_ranges %s
+                    order by start''' % (date, where), params)
+            while True:
+                rows = c.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+
+    def iter_data_all(self, batch=1000, raw_dates=False):
+        return self._iter_ranges('', [], batch, raw_dates)
+
+    def iter_data_since(self, since, batch=1000, raw_dates=False):
+        return self._iter_ranges('where date_changed >= ?', [since], batch,
+                raw_dates)
+
+    def iter_data_unsigned(self, batch=1000, raw_dates=False):
+        return self._iter_ranges("where signature = '' or signature is null",
+                [], batch, raw_dates)
+
+    def get_data_all(self):
+        return list(self.iter_data_all())
 
     def get_data_since(self, since):
-        c = self.conn.cursor()
-        c.execute('''select start, end, sip, owner, date_changed, signature
-                from numbex_ranges
-                where date_changed >= ?
-                order by start''', [since])
-        result = list(c)
-        c.close()
-        return result
+        return list(self.iter_data_since(since))
 
     def get_data_unsigned(self):
-        c = self.conn.cursor()
-        c.execute('''select start, end, sip, owner, date_changed, signature
-                from numbex_ranges
-                where signature = '' or signature is null
-                order by start''')
-        result = list(c)
-        c.close()
-        return result
+        return list(self.iter_data_unsigned())
 
     def get_public_keys(self, owner):
         c = self.conn.cursor()
@@ -226,40 +415,102 @@ W7d77Yq4f2BRkGFp/2Jz
         return '+%s'%num
 
     def check_record_signature(self, cur, start, end, sip, owner, mdate, sig):
-        keys = self._get_pub_keys(cur, owner)
+        keys = crypto.signature_keys(sig, self._get_pub_keys(cur, owner))
         for key in keys:
-            dsapub = crypto.parse_pub_key(key.encode('ascii'))
+            dsapub = crypto.cached_pub_key(owner, key)
             if crypto.check_signature(dsapub, sig,
                     start, end, sip, owner, mdate):
                 return True
         return False
 
     def check_data_signatures(self, data):
+        '''large batches are checked on all cores, see sigbatch'''
+        if any(len(row) != 6 for row in data):
+            return False
         cursor = self.conn.cursor()
         try:
-            for row in data:
-                if len(row) != 6:
-                    return False
-                if not self.check_record_signature(cursor, *row):
-                    return False
-            return True
+            keys = dict((owner, list(self._get_pub_keys(cursor, owner)))
+                    for owner in set(row[3] for row in data))
         finally:
             cursor.close()
+        return all(sigbatch.check_signatures(data, keys,
+                stop_on_failure=True, memo=self))
+
+    def get_verified(self, digests):
+        '''the set of digests given to add_verified before.  Only reads,
+the use is recorded by the next add_verified'''
+        found = set()
+        c = self.conn.cursor()
+        try:
+            # stay below the limit of 999 parameters
+            for i in xrange(0, len(digests), 500):
+                chunk = digests[i:i+500]
+                c.execute('''select digest from numbex_verified
+                        where digest in (%s)''' % ','.join('?' * len(chunk)),
+                        chunk)
+                found.update(d for d, in c)
+        finally:
+            c.close()
+        with self._verified_lock:
+            self._verified_used.update(found)
+        return found
+
+    @_writes
+    def add_verified(self, digests):
+        '''remembers digests, forgetting the least recently used ones
+beyond verified_keep'''
+        with self._verified_lock:
+            used, self._verified_used = self._verified_used, set()
+        used.difference_update(digests)
+        if not digests and not used:
+            return
+        c = self.conn.cursor()
+        # a replaced row gets a new rowid, so the oldest rowids are the
+        # least recently used, and there are at most verified_keep rows
+        # within the last verified_keep rowids
+        c.executemany('''insert or replace into numbex_verified (digest)
+                values (?)''', [(d,) for d in used])
+        c.executemany('''insert or replace into numbex_verified (digest)
+                values (?)''', [(d,) for d in digests])
+        c.execute('''delete from numbex_verified where rowid <=
+                (select max(rowid) from numbex_verified) - ?''',
+                [self.verified_keep])
+        c.close()
+        self.conn.commit()
 
     def _add_change(self, cursor, start, end, tp):
         assert tp in ('D', 'M', 'A')
         q = '''insert into numbex_range_changes (start, end, type)
                 values (?, ?, ?)'''
         cursor.execute(q, [start, end, tp])
-
-    def get_changed_data(self):
+        q = '''insert into numbex_range_journal (start, end)
+                values (?, ?)'''
+        cursor.execute(q, [start, end])
+
+    def _add_changes(self, cursor, changes):
+        '''_add_change for a list of (start, end, type)'''
+        cursor.executemany('''insert into numbex_range_changes
+                (start, end, type) values (?, ?, ?)''', changes)
+        cursor.executemany('''insert into numbex_range_journal (start, end)
+                values (?, ?)''', [c[:2] for c in changes])
+
+    def iter_changed_data(self, batch=1000):
         q = '''select type, start, end from numbex_range_changes
                 order by start'''
         c = self.conn.cursor()
-        c.execute(q)
-        r = list(c)
-        c.close()
-        return r
+        try:
+            c.execute(q)
+            while True:
+                rows = c.fetchmany(batch)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
+
+    def get_changed_data(self):
+        return list(self.iter_changed_data())
 
     def get_deleted_data(self):
         q = '''select start, end from numbex_range_changes
@@ -278,20 +529,115 @@ W7d77Yq4f2BRkGFp/2Jz
         c.close()
         return r
 
+    @_writes
     def clear_changed_data(self):
         q = '''delete from numbex_range_changes'''
         c = self.conn.cursor()
         c.execute(q)
+        q = '''delete from numbex_range_journal
+                where seq <= (select max(seq) from numbex_range_journal) - ?'''
+        c.execute(q, [self.journal_keep])
         c.close()
         self.conn.commit()
 
+    def data_version(self):
+        '''changes whenever another connection commits to the database;
+None if sqlite is too old to support it'''
+        c = self.conn.cursor()
+        r = list(c.execute('pragma data_version'))
+        c.close()
+        if not r:
+            return None
+        return r[0][0]
+
+    def get_journal_seq(self):
+        q = '''select max(seq) from numbex_range_journal'''
+        c = self.conn.cursor()
+        r = list(c.execute(q))[0][0]
+        c.close()
+        return r or 0
+
+    def get_journal_since(self, seq, limit=None):
+        '''returns a list of (start, end) spans changed after seq, or None
+if the journal has been pruned past seq or holds more than limit entries'''
+        q = '''select start, end from numbex_range_journal
+                where seq > ? order by seq'''
+        c = self.conn.cursor()
+        if limit is None:
+            r = list(c.execute(q, [seq]))
+        else:
+            r = list(c.execute(q + ' limit ?', [seq, limit + 1]))
+        # checked after the select so that pruning can't slip in between
+        first = list(c.execute('''select min(seq)
+                from numbex_range_journal'''))[0][0]
+        c.close()
+        if first is not None and first > seq + 1:
+            return None
+        if limit is not None and len(r) > limit:
+            return None
+        return r
+
+    @_writes
     def update_data(self, data):
+        '''merges data into the ranges: overlapped parts of existing ranges
+are cut away, a row with an empty sip deletes what it covers.  Returns
+False without changing anything if rows overlap each other or a range of
+another owner.
+
+the rows and the existing ranges they touch are both walked once in
+order of start; the resulting rows are written with executemany'''
         self.log.info("update data - %s rows", len(data))
         starttime = time.clock()
-        # check for overlaps
         data.sort(key=lambda x: int(x[0]))
-        prevs, preve = 0, 0
         cursor = self.conn.cursor()
+        try:
+            if data:
+                existing = self._get_ranges_in_span(cursor, int(data[0][0]),
+                        max(int(row[1]) for row in data))
+            else:
+                existing = []
+            if not self._check_update(data, existing):
+                return False
+            deleted, inserted, changes = self._plan_update(data, existing)
+            cursor.executemany('delete from numbex_ranges where start = ?',
+                    [[start] for start in deleted])
+            cursor.executemany('''insert into numbex_ranges
+                    (start, end, _s, _e, sip, owner, date_changed, signature)
+                    values (?, ?, ?, ?, ?, ?, ?, ?)''', inserted)
+            if inserted:
+                self._widen_max_span(cursor,
+                        max(r[3] - r[2] for r in inserted))
+            self._add_changes(cursor, changes)
+        except:
+            self.conn.rollback()
+            self.log.exception("update data failed after %.3fs",
+                    time.clock()-starttime)
+            raise
+        finally:
+            cursor.close()
+        self.conn.commit()
+        endtime = time.clock()
+        self.log.info("update data complete, %s deleted, %s written, %.3fs",
+                len(deleted), len(inserted), endtime-starttime)
+        return True
+
+    def _get_ranges_in_span(self, cursor, start, end):
+        '''the ranges that may overlap [start, end], ordered by start'''
+        # begin at the range containing start, if there is one; both
+        # bounds are on _s so this is a single index range scan
+        cursor.execute('''select start, end, sip, owner, date_changed,
+                    signature
+                from numbex_ranges
+                where _s >= coalesce((select max(_s) from numbex_ranges
+                        where _s <= ?), ?)
+                    and _s <= ?
+                order by _s''', [start, start, end])
+        return [_Range(r, r[0]) for r in cursor]
+
+    def _check_update(self, data, existing):
+        '''data and existing sorted by start'''
+        prevs, preve = 0, 0
+        j = 0
         for row in data:
             s, e = int(row[0]), int(row[1])
             if prevs <= s and preve >= s:
@@ -299,95 +645,203 @@ W7d77Yq4f2BRkGFp/2Jz
                         prevs, preve, s, e)
                 return False
             # check owners
-            overlaps = self.overlapping_ranges(s, e)
-            for ovl in overlaps:
-                old = self._get_range(cursor, ovl[0])
-                if old[3] != row[3]:
+            while j < len(existing) and existing[j].e < s:
+                j += 1
+            k = j
+            while k < len(existing) and existing[k].s <= e:
+                old = existing[k]
+                if old.owner != row[3]:
                     self.log.error("update data - %s %s overlaps with %s %s" \
                             " which has a different owner (%s vs %s)",
-                            s, e, ovl[0], ovl[1], row[3], old[3])
+                            s, e, old.start, old.end, row[3], old.owner)
                     return False
+                k += 1
             prevs, preve = s, e
+        return True
+
+    def _plan_update(self, data, existing):
+        '''applies data to existing in memory, as if every row was
+applied to the table in turn.  Returns the original starts of the ranges
+to delete, the rows to insert and the change log entries.'''
         num2str = self._numeric2string
         now = datetime.now()
-        try:
-            for row in data:
-                ns, ne = int(row[0]), int(row[1])
-                self.log.debug('processing [%s]', ', '.join(map(str, row)))
-                # empty sip address means "delete this range"
-                do_insert = (row[2] != "")
-                overlaps = self.overlapping_ranges(int(row[0]), int(row[1]))
-                for ovl in overlaps:
-                    os, oe = int(ovl[0]), int(ovl[1])
-                    # special case: new == old; update DSA signature
-                    # set signature to '' otherwise
-                    if os == ns and oe == ne:
-                        old = list(self._get_range(cursor, ovl[0]))
-                        for i,e in enumerate(old):
-                            if isinstance(e, unicode):
-                                old[i] = e.decode('utf-8')
-                        if not do_insert:
-                            self.log.debug('deleting %s %s', ovl[0], ovl[1])
-                            self.delete_range(cursor, ovl[0])
-                            self._add_change(cursor, ovl[0], ovl[1], 'D')
-                        elif old == row:
-                            self.log.debug('nothing to do for %s %s', ovl[0], ovl[1])
-                        elif old[:-1] == row[:-1]:
-                            self.log.debug('full equal, update sig %s %s',
-                                    ovl[0], ovl[1])
-                            self.set_range_small(cursor, ovl[0], ovl[0], ovl[1],
-                                    row[4], row[5])
-                            self._add_change(cursor, ovl[0], ovl[1], 'M')
-                        else:
-                            self.log.debug('equal ovl %s %s', ovl[0], ovl[1])
-                            self.set_range(cursor, ovl[0], *row)
-                            self._add_change(cursor, ovl[0], ovl[1], 'M')
+        final = []
+        deleted = []
+        changes = []
+        # ranges not yet passed by the rows; cutting a range can leave a
+        # piece after the current row, which goes back to the front
+        pending = deque(existing)
+        for row in data:
+            ns, ne = int(row[0]), int(row[1])
+            while pending and pending[0].e < ns:
+                final.append(pending.popleft())
+            overlaps = []
+            while pending and pending[0].s <= ne:
+                overlaps.append(pending.popleft())
+            after = []
+            # empty sip address means "delete this range"
+            do_insert = (row[2] != "")
+            for ovl in overlaps:
+                os, oe = ovl.s, ovl.e
+                # special case: new == old; update DSA signature
+                # set signature to '' otherwise
+                if os == ns and oe == ne:
+                    old = ovl.row()
+                    for i,e in enumerate(old):
+                        if isinstance(e, unicode):
+                            old[i] = e.decode('utf-8')
+                    if not do_insert:
+                        self._drop(ovl, deleted)
+                        changes.append((ovl.start, ovl.end, 'D'))
                         do_insert = False
-                    elif os >= ns and os <= ne and oe > ne: # left overlap
-                        self.log.debug('left ovl %s %s',ovl[0],ovl[1])
-                        self.set_range_small(cursor, ovl[0], num2str(ne+1), ovl[1], now)
-                        self._add_change(cursor, ovl[0], ovl[1], 'D')
-                        self._add_change(cursor, num2str(ne+1), ovl[1], 'A')
-                    elif oe >= ns and oe <= ne and os < ns: # right overlap
-                        self.log.debug('right ovl %s %s',ovl[0],ovl[1])
-                        self.set_range_small(cursor, ovl[0], ovl[0], num2str(ns-1), now)
-                        self._add_change(cursor, ovl[0], ovl[1], 'M')
-                    elif os >= ns and oe <= ne: # complete overlap, old is smaller
-                        self.log.debug('old smaller ovl %s %s',ovl[0],ovl[1])
-                        self.delete_range(cursor, ovl[0])
-                        self._add_change(cursor, ovl[0], ovl[1], 'D')
-                    elif os <= ns and oe >= ne: # complete overlap, new is smaller
-                        self.log.debug('new smaller ovl %s %s',ovl[0],ovl[1])
-                        old = self._get_range(cursor, ovl[0])
-                        self.set_range_small(cursor, ovl[0], ovl[0], num2str(ns-1), now)
-                        self.insert_range(cursor, num2str(ne+1), ovl[1],
-                                old[2], old[3], now, '', safe=True)
-                        self._add_change(cursor, ovl[0], ovl[1], 'M')
-                        self._add_change(cursor, num2str(ne+1), ovl[1], 'A')
-                if do_insert:
-                    row = list(row)
-                    self.insert_range(cursor, safe=True, *row)
-                    self._add_change(cursor, row[0], row[1], 'A')
-        except:
-            self.conn.rollback()
-            self.log.exception("update data failed after %.3fs", endtime-starttime)
-            raise
-        cursor.close()
+                        continue
+                    elif old == row:
+                        pass
+                    elif old[:-1] == row[:-1]:
+                        ovl.set(ovl.start, ovl.end, row[4], row[5])
+                        changes.append((ovl.start, ovl.end, 'M'))
+                    else:
+                        changes.append((ovl.start, ovl.end, 'M'))
+                        ovl.set(row[0], row[1], row[4], row[5])
+                        ovl.sip, ovl.owner = row[2], row[3]
+                    final.append(ovl)
+                    do_insert = False
+                elif os >= ns and os <= ne and oe > ne: # left overlap
+                    changes.append((ovl.start, ovl.end, 'D'))
+                    ovl.set(num2str(ne+1), ovl.end, now)
+                    changes.append((ovl.start, ovl.end, 'A'))
+                    after.append(ovl)
+                elif oe >= ns and oe <= ne and os < ns: # right overlap
+                    changes.append((ovl.start, ovl.end, 'M'))
+                    ovl.set(ovl.start, num2str(ns-1), now)
+                    final.append(ovl)
+                elif os >= ns and oe <= ne: # complete overlap, old is smaller
+                    self._drop(ovl, deleted)
+                    changes.append((ovl.start, ovl.end, 'D'))
+                elif os <= ns and oe >= ne: # complete overlap, new is smaller
+                    rest = _Range([num2str(ne+1), ovl.end, ovl.sip, ovl.owner,
+                        now, ''])
+                    changes.append((ovl.start, ovl.end, 'M'))
+                    changes.append((rest.start, rest.end, 'A'))
+                    ovl.set(ovl.start, num2str(ns-1), now)
+                    final.append(ovl)
+                    after.append(rest)
+            if do_insert:
+                new = _Range(row)
+                final.append(new)
+                changes.append((new.start, new.end, 'A'))
+            pending.extendleft(reversed(after))
+        final.extend(pending)
+        inserted = []
+        for r in final:
+            if r.dirty:
+                if r.orig is not None:
+                    deleted.append(r.orig)
+                inserted.append([r.start, r.end, r.s, r.e, r.sip, r.owner,
+                    r.date, r.sig])
+        return deleted, inserted, changes
+
+    def _drop(self, r, deleted):
+        if r.orig is not None:
+            deleted.append(r.orig)
+
+    @_writes
+    def bulk_load(self, data, batch=100000):
+        '''fills an empty numbex_ranges with data, sorted by start.
+
+Returns False without loading anything if rows overlap.  Rows with an
+empty sip are skipped as update_data would.  Nothing is recorded in
+numbex_range_changes, the journal gets one entry spanning all rows.  The
+_s and _e indexes are dropped during the load and syncing is off, so a
+crash in between leaves a database to import again.'''
+        if not self.ranges_empty():
+            raise ValueError("bulk load into a database with ranges")
+        self.log.info("bulk load - %s rows", len(data))
+        starttime = time.time()
+        rows = []
+        prev = None
+        span = 0
+        for row in data:
+            s, e = int(row[0]), int(row[1])
+            if s > e or prev is not None and s <= prev:
+                self.log.error("bulk load - invalid data %s %s after %s",
+                        s, e, prev)
+                return False
+            prev = e
+            if row[2] == "":
+                continue
+            span = max(span, e - s)
+            rows.append([row[0], row[1], s, e, row[2], row[3],
+                utils.parse_datetime_iso(row[4]), row[5]])
+        c = self.conn.cursor()
         self.conn.commit()
-        endtime = time.clock()
-        self.log.info("update data complete, %.3fs", endtime-starttime)
+        sync = list(c.execute('pragma synchronous'))[0][0]
+        journal = list(c.execute('pragma journal_mode'))[0][0]
+        c.execute('pragma synchronous = off')
+        if journal != 'wal':
+            c.execute('pragma journal_mode = memory')
+        try:
+            c.execute('drop index ranges_s_index')
+            c.execute('drop index ranges_e_index')
+            try:
+                for i in xrange(0, len(rows), batch):
+                    c.executemany('''insert into numbex_ranges
+                        (start, end, _s, _e, sip, owner, date_changed,
+                         signature)
+                        values (?, ?, ?, ?, ?, ?, ?, ?)''', rows[i:i+batch])
+                    self.conn.commit()
+                    self.log.debug("bulk load - %s rows written",
+                            min(i + batch, len(rows)))
+                if rows:
+                    self._widen_max_span(c, span)
+                    c.execute('''insert into numbex_range_journal (start, end)
+                        values (?, ?)''', [rows[0][0], rows[-1][1]])
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                c.execute('delete from numbex_ranges')
+                self.conn.commit()
+                raise
+            finally:
+                c.execute('create unique index ranges_s_index '
+                        'on numbex_ranges(_s)')
+                c.execute('create unique index ranges_e_index '
+                        'on numbex_ranges(_e)')
+                self.conn.commit()
+        finally:
+            c.execute('pragma journal_mode = %s' % journal)
+            c.execute('pragma synchronous = %d' % sync)
+            c.close()
+        self.log.info("bulk load complete, %s rows, %.3fs", len(rows),
+                time.time()-starttime)
         return True
 
+    # ranges overlapping [start, end], takes start, end, start.  No range
+    # is longer than max_span, so this is one seek on the _s index instead
+    # of a scan for _e >= start
+    _OVERLAPS = '''_s >= ? - (select value from numbex_meta
+                where name = 'max_span')
+            and _s <= ? and _e >= ?'''
+
     def overlapping_ranges(self, start, end):
         assert int(start) <= int(end)
         c = self.conn.cursor()
         c.execute('''select start, end
                 from numbex_ranges
-                where (_s >= ? and _s <= ?) -- left overlap
-                    or (_e >= ? and _e <= ?) -- right overlap
-                    or (_s <= ? and _e >= ?) -- complete overlap
-                    or (_s >= ? and _e <= ?) -- complete overlap''',
-                [start, end, start, end, start, end, start, end])
+                where %s''' % self._OVERLAPS,
+                [int(start), int(end), int(start)])
+        result = list(c)
+        c.close()
+        return result
+
+    def get_data_overlapping(self, start, end):
+        assert int(start) <= int(end)
+        c = self.conn.cursor()
+        start = int(start)
+        c.execute('''select start, end, sip, owner, date_changed, signature
+                from numbex_ranges
+                where %s
+                order by _s''' % self._OVERLAPS, [start, int(end), start])
         result = list(c)
         c.close()
         return result
@@ -409,13 +863,16 @@ W7d77Yq4f2BRkGFp/2Jz
             raise RuntimeError("multiple records found for key %s"%start)
         return r[0]
 
-    def get_range_for(self, number):
+    def get_range_for(self, number, prefix=False):
+        '''prefix: read number as a digit string and return the range
+covering its longest prefix (see prefixindex.PrefixIndex)'''
+        if prefix:
+            return self._get_prefix_range_for(number)
         c = self.conn.cursor()
         number = int(number)
         c.execute('''select start, end, sip, owner, date_changed, signature
                 from numbex_ranges
-                where (_s <= ? and _e >= ?)''',
-                [number, number])
+                where %s''' % self._OVERLAPS, [number, number, number])
         result = list(c)
         c.close()
         if len(result) > 1:
@@ -426,7 +883,29 @@ W7d77Yq4f2BRkGFp/2Jz
             return None
 
 
+    def _get_prefix_range_for(self, number):
+        digits = prefixindex.digits_of(number)
+        c = self.conn.cursor()
+        try:
+            for length in xrange(len(digits), 0, -1):
+                n = int(digits[:length])
+                # start and end carry a leading '+'
+                c.execute('''select start, end, sip, owner, date_changed,
+                        signature
+                    from numbex_ranges
+                    where %s
+                        and length(start) <= ? and length(end) >= ?'''
+                    % self._OVERLAPS, [n, n, n, length+1, length+1])
+                result = list(c)
+                if result:
+                    return result[0]
+            return None
+        finally:
+            c.close()
+
+    @_writes
     def set_range_small(self, cursor, start, newstart, newend, date_changed, sig=''):
+        cursor = self._writer_cursor(cursor)
         ns = int(newstart)
         ne = int(newend)
         date_changed = utils.parse_datetime_iso(date_changed)
@@ -438,9 +917,12 @@ W7d77Yq4f2BRkGFp/2Jz
                 signature = ?
                 where start = ?''',
                 [newstart, newend, ns, ne, date_changed, sig, start])
+        self._widen_max_span(cursor, ne - ns)
         return True
 
+    @_writes
     def set_range(self, cursor, start, newstart, newend, sip, owner, date_changed, sig):
+        cursor = self._writer_cursor(cursor)
         ns = int(newstart)
         ne = int(newend)
         self.log.debug('set full %s => %s %s',start,newstart,newend)
@@ -452,10 +934,13 @@ W7d77Yq4f2BRkGFp/2Jz
                 owner = ?, date_changed = ?, signature = ?
                 where start = ?''',
                 [newstart, newend, ns, ne, sip, owner, date_changed, sig, start])
+        self._widen_max_span(cursor, ne - ns)
         return True
 
+    @_writes
     def insert_range(self, cursor, start, end, sip, owner, date_changed, sig,
                 safe=True):
+        cursor = self._writer_cursor(cursor)
         ns = int(start)
         ne = int(end)
         date_changed = utils.parse_datetime_iso(date_changed)
@@ -470,9 +955,12 @@ W7d77Yq4f2BRkGFp/2Jz
                 (start, end, _s, _e, sip, owner, date_changed, signature)
                 values (?, ?, ?, ?, ?, ?, ?, ?)''',
                 [start, end, ns, ne, sip, owner, date_changed, sig])
+        self._widen_max_span(cursor, ne - ns)
         return True
 
+    @_writes
     def delete_range(self, cursor, start):
+        cursor = self._writer_cursor(cursor)
         self.log.debug('delete %s',start)
         cursor.execute('''delete from numbex_ranges
                 where start = ?''',
@@ -496,15 +984,20 @@ W7d77Yq4f2BRkGFp/2Jz
         c.close()
         return r
 
+    @_writes
     def remove_public_key(self, keyid):
         q = 'delete from numbex_pubkeys where id = ?'
         c = self.conn.cursor()
+        for owner, in list(c.execute('''select owner from numbex_pubkeys
+                where id = ?''', [keyid])):
+            crypto.forget_pub_keys(owner)
         c.execute(q, [keyid])
         r = list(c)
         c.close()
         self.conn.commit()
         return r
 
+    @_writes
     def add_public_key(self, owner, pubkey):
         q = '''insert into numbex_pubkeys (owner, pubkey)
                values (?, ?)'''
@@ -512,5 +1005,6 @@ W7d77Yq4f2BRkGFp/2Jz
         c.execute(q, [owner, pubkey])
         c.close()
         self.conn.commit()
+        crypto.forget_pub_keys(owner)
 
 
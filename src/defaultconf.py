@@ -1,3 +1,9 @@
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+from ConfigParser import SafeConfigParser as ConfigParser
+
 defaults = '''# default config
 [DEFAULT]
 prefix = /usr/local/numbex
@@ -27,6 +33,12 @@ host =
 [UDP]
 # multiple values allowed
 ports = 8990 8991 8992
+# host:port of caching stubs told about changed ranges, see
+# numbex_udp_cache.py; multiple values allowed
+caches =
+# seconds between looks at the journal for changes made over SOAP or
+# the control interface, to tell the caches about
+invalidate_interval = 5
 
 [SOAP]
 port = 8000
@@ -44,3 +56,11 @@ path = %(prefix)s/var/db/db.sqlite3
 # timeout for records exported in hours
 export_timeout = 96
 '''
+
+
+def read_config(confname):
+    cfg = ConfigParser()
+    sio = StringIO(defaults)
+    cfg.readfp(sio, 'default')
+    cfg.read(confname)
+    return cfg
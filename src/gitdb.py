@@ -12,7 +12,7 @@ import operator
 import gitshelve
 import quicksect
 
-import crypto
+import sigbatch
 import utils
 
 
@@ -21,7 +21,9 @@ class NumbexDBError(Exception):
         Exception.__init__(self, *args, **kwargs)
 
 class NumbexRepo(object):
-    def __init__(self, repodir, pubkey_getter, repobranch='numbex'):
+    def __init__(self, repodir, pubkey_getter, repobranch='numbex',
+            memo=None):
+        '''memo: remembers valid signatures, see sigbatch'''
         self.repobranch = repobranch
         self.repodir = repodir
         if self.repodir and self.repobranch:
@@ -29,6 +31,7 @@ class NumbexRepo(object):
         else:
             self.shelf = None
         self.get_pubkeys = pubkey_getter
+        self.memo = memo
         self.daemon = None
         self.log = logging.getLogger("git")
     
@@ -83,27 +86,22 @@ Signature: $sig\n''')
         '''data format: iterator of records in format produced by parse_record'''
         self.log.info('importing %s records...', len(data))
         tstart = time.time()
-        keycache = {}
+        keys = {}
         for row in data:
             if len(row) != 6:
                 self.log.warning("invalid record %s", row)
                 return False
             owner = row[3]
-            if not owner in keycache:
-                pemkeys = [k.encode('ascii') if isinstance(k, unicode) else k
-                            for k in self.get_pubkeys(owner)]
-                keycache[owner] = [crypto.parse_pub_key(k) for k in pemkeys]
-                if not keycache[owner]:
+            if not owner in keys:
+                keys[owner] = list(self.get_pubkeys(owner))
+                if not keys[owner]:
                     self.log.warning("no key found for %s", row)
                     return False
-            checked_data = row[:-1]
-            sig = row[-1]
-            if not any(crypto.check_signature(key, row[-1], *row[:-1])
-                    for key in keycache[owner]):
-                self.log.warning("invalid signature %s", row)
-                return False
-            else:
-                self.log.debug("signature valid for %s", row)
+        checked = sigbatch.check_signatures(data, keys, stop_on_failure=True,
+                memo=self.memo)
+        if not all(checked):
+            self.log.warning("invalid signature %s", data[len(checked)-1])
+            return False
 
         shelf = self.shelf
         if delete is not None:
@@ -372,7 +370,8 @@ Signature: $sig\n''')
 
             # check if there aren't any overlaps before the merge
             self.log.info("checking for overlaps")
-            db2 = NumbexRepo(self.repodir, self.get_pubkeys, integration)
+            db2 = NumbexRepo(self.repodir, self.get_pubkeys, integration,
+                    self.memo)
             ovlself = self.check_overlaps()
             if ovlself:
                 raise NumbexDBError("repository has overlapping ranges: %s"%ovlself)
@@ -421,7 +420,8 @@ Signature: $sig\n''')
                 raise
             finally:
                 os.chdir(cwd)
-            fixdb = NumbexRepo(tmprepo, self.get_pubkeys, self.repobranch)
+            fixdb = NumbexRepo(tmprepo, self.get_pubkeys, self.repobranch,
+                    self.memo)
             fixdb.fix_overlaps2(overlaps, db2)
             fixdb.sync()
 
@@ -478,14 +478,11 @@ Signature: $sig\n''')
         rec1 = self.parse_record(v1)
         rec2 = self.parse_record(v2)
         # check signatures
-        if not any(crypto.check_signature(crypto.parse_pub_key(k.encode()),
-                rec1[5], *rec1)
-                for k in self.get_pubkeys(rec1[3])):
-            raise NumbexDBError('invalid signature on %s'%rec1)
-        if not any(crypto.check_signature(crypto.parse_pub_key(k.encode()),
-                rec2[5], *rec2)
-                for k in self.get_pubkeys(rec2[3])):
-            raise NumbexDBError('invalid signature on %s'%rec2)
+        keys = dict((r[3], list(self.get_pubkeys(r[3]))) for r in (rec1, rec2))
+        for r, ok in zip((rec1, rec2), sigbatch.check_signatures((rec1, rec2),
+                keys, memo=self.memo)):
+            if not ok:
+                raise NumbexDBError('invalid signature on %s'%r)
         # compare owners
         if rec1[3] != rec2[3]:
             raise NumbexDBError('cannot merge %s and %s - owners differ'%(rec1, rec2))
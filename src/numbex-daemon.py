@@ -10,11 +10,6 @@ import os
 import signal
 import random
 import re
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
-from ConfigParser import SafeConfigParser as ConfigParser
 from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCDispatcher, \
         SimpleXMLRPCRequestHandler, Fault
 from Queue import Queue
@@ -25,15 +20,9 @@ from numbex_server import MyNumbexService
 from tracker_client import NumbexPeer
 from gitdb import NumbexRepo
 from database import Database
-
-
-def read_config(confname):
-    from defaultconf import defaults
-    cfg = ConfigParser()
-    sio = StringIO(defaults)
-    cfg.readfp(sio, 'default')
-    cfg.read(confname)
-    return cfg
+from defaultconf import read_config
+import numbex_udp_cache
+import sigbatch
 
 
 class NumbexDaemon(object):
@@ -52,6 +41,10 @@ class NumbexDaemon(object):
         self.gitlock = threading.Lock()
         self.had_import_error = False
         self.had_export_error = False
+        # journal entry the caches were last told about
+        self.cache_seq = None
+        self.cachelock = threading.Lock()
+        self.cache_watcher_running = False
 
     def reload_config(self, configname):
         newcfg = read_config(confname)
@@ -118,12 +111,11 @@ class NumbexDaemon(object):
 
     def _updater_thread(self):
         self.log.info("starting update processor")
-        # need our own database connection here
-        # and our own git, too, since it needs public keys
-        db = Database(os.path.expanduser(self.cfg.get('DATABASE', 'path')),
-                fill_example=False)
+        # the database hands every thread its own connection, but git
+        # needs one of our own, since it needs public keys
+        db = self.db
         git = NumbexRepo(os.path.expanduser(self.cfg.get('GIT', 'path')),
-                db.get_public_keys)
+                db.get_public_keys, memo=db)
         self.updater_worker_stopped = False
         while self.updater_running:
             requested = self.updater_reqs.get()
@@ -228,21 +220,32 @@ class NumbexDaemon(object):
         return True
 
     def _import_from_p2p(self, db, force_all=False):
-        if force_all or db.ranges_empty():
-            if force_all:
+        empty = db.ranges_empty()
+        if force_all or empty:
+            if not empty:
                 self.log.info("forced import of everything")
             else:
                 self.log.info("database empty, importing all...")
             start = time.time()   
-            r = db.update_data(self.git.export_data_all())
+            r = None
+            if empty:
+                try:
+                    r = db.bulk_load(self.git.export_data_all())
+                except ValueError, e:
+                    # ranges came in since ranges_empty()
+                    self.log.info("bulk load refused (%s), merging instead",
+                            e)
+            if r is None:
+                r = db.update_data(self.git.export_data_all())
             db.clear_changed_data()
             end = time.time()
             if r:
                 self.log.info("database import completed in %.3f", end-start)
+                self._invalidate_changes(db, flush=True)
                 return True, ""
             else:
                 self.log.warn("database import failed, time %.3f", end-start)
-                return False, "update_data returned False"
+                return False, "import of all data failed"
 
         if db.has_changed_data():
             return False, "database has changed data"
@@ -257,11 +260,64 @@ class NumbexDaemon(object):
         end = time.time()
         if r:
             self.log.info("database import completed in %.3f", end-start)
+            self._invalidate_changes(db)
             return True, ""
         else:
             self.log.info("database import failed, time %.3f", end-start)
             return False, "update_data returned False"
 
+    def _invalidate_caches(self, db, seq):
+        '''tells the caching stubs about ranges changed after journal
+entry seq, or to drop everything if seq is None'''
+        caches = []
+        for x in self.cfg.get('UDP', 'caches').split():
+            host, port = x.rsplit(':', 1)
+            caches.append((host, int(port)))
+        if not caches:
+            return
+        spans = None
+        if seq is not None:
+            spans = db.get_journal_since(seq, 10000)
+            if spans == []:
+                return
+        numbex_udp_cache.invalidate(caches, spans)
+
+    def _invalidate_changes(self, db, flush=False):
+        '''tells the caching stubs about ranges changed since the last
+call, whatever changed them; everything is dropped with flush'''
+        with self.cachelock:
+            seq = db.get_journal_seq()
+            if flush or self.cache_seq is None:
+                self._invalidate_caches(db, None)
+            elif seq != self.cache_seq:
+                self._invalidate_caches(db, self.cache_seq)
+            self.cache_seq = seq
+
+    def _cache_watcher_thread(self):
+        # SOAP updates and the like write without telling anyone
+        self.log.info("starting cache invalidation")
+        while self.cache_watcher_running:
+            time.sleep(self.cfg.getint('UDP', 'invalidate_interval'))
+            if not self.cache_watcher_running:
+                break
+            try:
+                self._invalidate_changes(self.db)
+            except:
+                self.log.exception("invalidating caches failed")
+        self.log.info("cache invalidation stopped")
+
+    def cache_watcher_start(self):
+        if self.cache_watcher_running:
+            return False
+        if not self.cfg.get('UDP', 'caches').split() or \
+                self.cfg.getint('UDP', 'invalidate_interval') <= 0:
+            return False
+        self.cache_watcher_running = True
+        t = threading.Thread(target=self._cache_watcher_thread)
+        t.daemon = True
+        t.start()
+        return True
+
     def import_from_p2p(self, force_all=False):
         return self._import_from_p2p(self.db, force_all)
 
@@ -331,7 +387,7 @@ class NumbexDaemon(object):
         self.log.info("starting SOAP controller on port %s...", port)
         dbpath = os.path.expanduser(self.cfg.get('DATABASE', 'path'))
         t = threading.Thread(target=AsServer,
-                kwargs=dict(port=port, services=[MyNumbexService(dbpath),]))
+                kwargs=dict(port=port, services=[MyNumbexService(dbpath, self.db),]))
         t.daemon = True
         t.start()
 
@@ -339,8 +395,9 @@ class NumbexDaemon(object):
         gitpath = os.path.expanduser(self.cfg.get('GIT', 'path'))
         self.db = Database(os.path.expanduser(self.cfg.get('DATABASE', 'path')),
                 fill_example=False)
+        self.cache_seq = self.db.get_journal_seq()
         self.git = NumbexRepo(os.path.expanduser(self.cfg.get('GIT', 'path')),
-                self.db.get_public_keys)
+                self.db.get_public_keys, memo=self.db)
         if self.db.ranges_empty():
             self.log.info("initial database empty")
             self.import_from_p2p()
@@ -351,6 +408,7 @@ class NumbexDaemon(object):
                 self.log.error("import failed", msg)
         self.p2p_start()
         self.updater_start()
+        self.cache_watcher_start()
         self._soap_start()
         signal.signal(signal.SIGTERM, self._exit)
 
@@ -386,12 +444,14 @@ class NumbexDaemon(object):
         sys.exit(0)
 
     def _stop(self):
+        self.cache_watcher_running = False
         self.updater_stop()
         self.p2p_stop()
         if self.git is not None:
             self.git.dispose()
             self.git = None
         self.db = None
+        sigbatch.stop_pool()
 
 
 def main():
@@ -409,6 +469,8 @@ def main():
         logging.config.fileConfig(cfg.get('GLOBAL', 'logging_config'))
     if options.log_config_file:
         logging.config.fileConfig(options.log_config_file)
+    # fork the signature workers before any thread or database connection
+    sigbatch.start_pool()
     daemon = NumbexDaemon(cfg)
     daemon._main()
 
@@ -13,11 +13,16 @@ except ImportError:
 
 from NumbexServiceService_client import *
 import crypto
+import sigbatch
 import utils
 
 _outfile = sys.stdout
 _tracefile = None
 _url = 'http://localhost:8000/'
+# rows per receiveUpdates call of sendsign, None for all in one
+_chunk_size = None
+# signing processes, None for one per cpu
+_jobs = None
 
 def pull_all(url=None):
     if url is None:
@@ -70,37 +75,69 @@ def send(filename, url=None):
         sys.exit(1)
 
 
-def send_sign(csvfile, keyfile, url=None):
-    if url is None:
-        url = _url
-    try:
-        dsa = crypto.parse_priv_key(keyfile.read())
-    except AttributeError:
-        dsa = crypto.parse_priv_key(file(keyfile).read())
-    loc = NumbexServiceServiceLocator()
-    port = loc.getNumbexServicePort(url=url, tracefile=_tracefile)
-
-    msg = receiveUpdates()
+def _read_rows(csvfile):
     if isinstance(csvfile, basestring):
         reader = csv.reader(file(csvfile))
     else:
         reader = csv.reader(csvfile)
-    sio = StringIO()
-    writer = csv.writer(sio)
-
     for row in reader:
         if len(row) < 5:
             logging.error("invalid record: %s", row)
             sys.exit(1)
         row[4] = utils.parse_datetime_iso(row[4])
-        sig = crypto.sign_record(dsa, *row[:5])
-        writer.writerow((row[0], row[1], row[2], row[3], row[4].isoformat(), sig))
+        yield row[:5]
 
-    msg._csv = sio.getvalue()
-    rsp = port.receiveUpdates(msg)
-    if not rsp._return:
-        logging.error("send: receiveUpdates() failed, check input data")
-        sys.exit(1)
+def _signed_rows(csvfile, keyfile):
+    '''the rows of csvfile signed with keyfile, on all cores'''
+    try:
+        pem = keyfile.read()
+    except AttributeError:
+        pem = file(keyfile).read()
+    def progress(n):
+        sys.stderr.write('\r%s rows signed' % n)
+    return sigbatch.sign_rows(_read_rows(csvfile), pem, processes=_jobs,
+            progress=progress)
+
+def sign(csvfile, keyfile):
+    '''writes csvfile signed with keyfile to the output file as the rows
+are signed'''
+    writer = csv.writer(_outfile)
+    for row in _signed_rows(csvfile, keyfile):
+        writer.writerow(row)
+    sys.stderr.write('\n')
+
+def send_sign(csvfile, keyfile, url=None, chunk_size=None):
+    '''chunk_size: send the rows in updates of this many, they are
+checked against each other for overlaps only within an update'''
+    if url is None:
+        url = _url
+    if chunk_size is None:
+        chunk_size = _chunk_size
+    loc = NumbexServiceServiceLocator()
+    port = loc.getNumbexServicePort(url=url, tracefile=_tracefile)
+
+    def upload(data):
+        msg = receiveUpdates()
+        msg._csv = data
+        rsp = port.receiveUpdates(msg)
+        if not rsp._return:
+            logging.error("send: receiveUpdates() failed, check input data")
+            sys.exit(1)
+    sio = StringIO()
+    writer = csv.writer(sio)
+    count = sent = 0
+    for row in _signed_rows(csvfile, keyfile):
+        writer.writerow(row)
+        count += 1
+        if chunk_size and count == chunk_size:
+            upload(sio.getvalue())
+            sio = StringIO()
+            writer = csv.writer(sio)
+            sent += count
+            count = 0
+    sys.stderr.write('\n')
+    if count or not sent:
+        upload(sio.getvalue())
 
 
 def get_public_keys(owner, url=None):
@@ -152,7 +189,7 @@ def send_public_key(owner, keyfile, url=None):
 
 
 def main():
-    global _tracefile, _outfile, _url
+    global _tracefile, _outfile, _url, _chunk_size, _jobs
     usage = """%prog [options] <command>\n
 Available commands:
     pull <DATE_SINCE>\tget numer ranges modified after DATE_SINCE
@@ -161,6 +198,8 @@ Available commands:
     sendsign <CSVFILE> <KEYFILE>
                      \tsend the contents of CSVFILE as an update, sign them
                      \twith KEYFILE (PEM private key)
+    sign <CSVFILE> <KEYFILE>
+                     \twrite the contents of CSVFILE signed with KEYFILE
     send <CSVFILE>   \tsend the contents of CSVFILE as an update
     getpubkeys <OWNER>\tget public keys of OWNER
     sendpubkey <OWNER> <KEYFILE>
@@ -175,8 +214,14 @@ Available commands:
             metavar="TRACEFILE")
     op.add_option("-u", "--url", help="url of the webservice",
             metavar="URL", default=_url)	
+    op.add_option("-c", "--chunk-size", type="int",
+            help="sendsign: send ROWS rows per update", metavar="ROWS")
+    op.add_option("-j", "--jobs", type="int",
+            help="signing processes, default one per cpu", metavar="JOBS")
     options, args = op.parse_args()
     _tracefile = options.trace_file
+    _chunk_size = options.chunk_size
+    _jobs = options.jobs
     if options.output_file:
         _outfile = file(options.output_file, "wb")
     if len(args) < 1:
@@ -188,6 +233,7 @@ Available commands:
                 'pullsign': pull_sign,
                 'send': send,
                 'sendsign': send_sign,
+                'sign': sign,
                 'getpubkeys': get_public_keys,
                 'rmpubkey': remove_public_key,
                 'sendpubkey': send_public_key,
@@ -22,22 +22,24 @@ import crypto
 class MyNumbexService(NumbexServiceService):
     # Make WSDL available for HTTP GET
     _wsdl = file("NumbexServiceService.wsdl").read()
-    def __init__(self, dbfile="tmp.db", *args, **kwargs):
+    def __init__(self, dbfile="tmp.db", db=None, *args, **kwargs):
+        '''db: a Database to share, it hands the serving thread a
+connection of its own'''
         NumbexServiceService.__init__(self, *args, **kwargs)
         self.dbfile = dbfile
-        self.db = None
+        self.db = db
 
     def _init_db(self):
-        'deferred init of db to preserve threading constraints'
+        'deferred init of db, creating it may fill in the example data'
         if self.db is None:
             self.db = Database(self.dbfile)
 
 
     def _transform_to_csv(self, data):
+        '''data: rows from the Database.iter_* methods with raw_dates'''
         ofile = StringIO()
         csvwriter = csv.writer(ofile)
-        for start, end, sip, owner, date, sig in data:
-            csvwriter.writerow([start, end, sip, owner, date.isoformat(), sig])
+        csvwriter.writerows(data)
         return ofile.getvalue()
 
     def soap_getData(self, ps, **kw):
@@ -45,7 +47,8 @@ class MyNumbexService(NumbexServiceService):
         # input/output data structures
         self._init_db()
         request, response = NumbexServiceService.soap_getData(self, ps, **kw)
-        data = self._transform_to_csv(self.db.get_data_all())
+        data = self._transform_to_csv(
+                self.db.iter_data_all(raw_dates=True))
         response._return = data
         return request, response
 
@@ -53,7 +56,8 @@ class MyNumbexService(NumbexServiceService):
         self._init_db()
         request, response = NumbexServiceService.soap_getUpdates(self, ps, **kw)
         since = datetime.fromtimestamp(time.mktime(request._parameter))
-        response._return = self._transform_to_csv(self.db.get_data_since(since))
+        response._return = self._transform_to_csv(
+                self.db.iter_data_since(since, raw_dates=True))
         return request, response
 
     def soap_receiveUpdates(self, ps, **kw):
@@ -71,7 +75,8 @@ class MyNumbexService(NumbexServiceService):
     def soap_getUnsigned(self, ps, **kw):
         self._init_db()
         request, response = NumbexServiceService.soap_getUnsigned(self, ps, **kw)
-        response._return = self._transform_to_csv(self.db.get_data_unsigned())
+        response._return = self._transform_to_csv(
+                self.db.iter_data_unsigned(raw_dates=True))
         return request, response
 
     def soap_getPublicKeys(self, ps, **kw):
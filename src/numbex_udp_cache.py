@@ -0,0 +1,322 @@
+#!/usr/bin/python
+import socket
+import logging
+import time
+import signal
+import select
+import errno
+
+import utils
+from numbex_udp_client import Client, UDPServerException, MAX_DATAGRAM
+from numbex_udp_client import servers_from_config
+
+OK_HEADER = '200 OK\n'
+NOT_FOUND = '404 Not found\n'
+UNAVAILABLE = '503 Upstream not responding\n'
+
+class CacheEntry(object):
+    def __init__(self, reply, ttl, refresh):
+        now = time.time()
+        self.reply = reply
+        self.expires = now + ttl
+        self.refresh_at = now + ttl * refresh
+        self.hits = 0
+
+
+class CachingResolver(object):
+    '''answers lookups from a local cache in front of a Client.
+
+answers are kept for ttl seconds, misses and malformed numbers for
+negative_ttl, at most size of them with the least recently used dropped
+first.  An entry hit at least popular times is fetched again once
+refresh of its ttl has passed, so busy numbers don't expire.  Concurrent
+lookups of a number not in the cache share one upstream query.'''
+    def __init__(self, client, size=100000, ttl=300, negative_ttl=30,
+            refresh=0.8, popular=2):
+        self.client = client
+        self.cache = utils.LRUCache(size)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh = refresh
+        self.popular = popular
+        self.waiting = {} # number -> callbacks waiting for the upstream
+        # bumped by invalidate(), answers fetched before are not cached
+        self.generation = 0
+        self.counts = dict.fromkeys(('hit', 'miss', 'refresh', 'upstream',
+            'unavailable', 'invalidated'), 0)
+
+    def lookup(self, number, callback):
+        '''calls callback(reply) with the reply the server would send,
+right away on a cache hit, from client.poll() otherwise'''
+        entry = self.cache.get(number)
+        now = time.time()
+        if entry is not None and entry.expires > now:
+            self.counts['hit'] += 1
+            entry.hits += 1
+            if now >= entry.refresh_at and entry.hits >= self.popular \
+                    and number not in self.waiting:
+                self.counts['refresh'] += 1
+                self._fetch(number)
+            callback(entry.reply)
+            return
+        self.counts['miss'] += 1
+        if number in self.waiting:
+            self.waiting[number].append(callback)
+        else:
+            self._fetch(number).append(callback)
+
+    def _fetch(self, number):
+        waiters = self.waiting[number] = []
+        generation = self.generation
+        def fetched(number, result):
+            self._fetched(number, result, generation)
+        self.counts['upstream'] += 1
+        self.client.submit(number, fetched)
+        return waiters
+
+    def _fetched(self, number, result, generation):
+        ttl = self.negative_ttl
+        if isinstance(result, socket.timeout):
+            self.counts['unavailable'] += 1
+            entry = self.cache.get(number)
+            # a stale answer beats none
+            if entry is not None:
+                reply = entry.reply
+            else:
+                reply = UNAVAILABLE
+            ttl = None
+        elif isinstance(result, UDPServerException):
+            reply = str(result)
+            if reply.startswith('503'):
+                # the server is busy, that says nothing about the number
+                ttl = None
+        elif result is None:
+            reply = NOT_FOUND
+        else:
+            reply = OK_HEADER + result + '\n'
+            ttl = self.ttl
+        if ttl is not None and generation == self.generation:
+            self.cache.put(number, CacheEntry(reply, ttl, self.refresh))
+        for callback in self.waiting.pop(number, ()):
+            callback(reply)
+
+    def invalidate(self, spans=None):
+        '''drops the cached numbers within any (start, end) of spans,
+everything if spans is None'''
+        self.generation += 1
+        if spans is None:
+            self.counts['invalidated'] += len(self.cache)
+            self.cache.clear()
+            return
+        spans = [(int(s), int(e)) for s, e in spans]
+        for number in self.cache.keys():
+            try:
+                n = int(number)
+            except ValueError:
+                continue
+            for s, e in spans:
+                if s <= n <= e:
+                    self.cache.pop(number)
+                    self.counts['invalidated'] += 1
+                    break
+
+
+def multi_line(number, reply):
+    '''the status line for number in a MULTI reply'''
+    if reply[0] == '2':
+        return '200 ' + reply[len(OK_HEADER):]
+    elif reply[0] == '4':
+        return '404 %s\n' % number
+    return reply
+
+
+class CacheServer(object):
+    '''speaks the numbex UDP protocol on a local port and answers from a
+CachingResolver.  Besides lookups it takes "FLUSH" and "INVALIDATE"
+followed by one "start end" line per span, from loopback addresses
+only.'''
+    def __init__(self, resolver, host='localhost', port=8989):
+        self.resolver = resolver
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.setblocking(0)
+        self.running = False
+
+    def _reply(self, address, tag, reply):
+        try:
+            self.sock.sendto(tag + reply, address)
+        except socket.error, e:
+            logging.warning('error sending to %s: %s', address, e)
+
+    def _control(self, address, lines):
+        if not address[0].startswith('127.'):
+            return '403 Forbidden\n'
+        if lines[0] == 'FLUSH':
+            self.resolver.invalidate()
+        else:
+            try:
+                spans = [line.split() for line in lines[1:] if line.strip()]
+                self.resolver.invalidate([(s, e) for s, e in spans])
+            except ValueError, e:
+                return '500 invalid span: %s\n' % e
+        return OK_HEADER
+
+    def _multi(self, address, tag, numbers):
+        lines = [None] * len(numbers)
+        left = [len(numbers)]
+        def answered(i):
+            def callback(reply):
+                lines[i] = multi_line(numbers[i], reply)
+                left[0] -= 1
+                if not left[0]:
+                    self._send_multi(address, tag, lines)
+            return callback
+        if not numbers:
+            self._send_multi(address, tag, lines)
+        for i, number in enumerate(numbers):
+            self.resolver.lookup(number, answered(i))
+
+    def _send_multi(self, address, tag, lines):
+        size = len(tag) + len('210 OK %d\n' % len(lines))
+        count = 0
+        for line in lines:
+            size += len(line)
+            if size > MAX_DATAGRAM:
+                break
+            count += 1
+        self._reply(address, tag,
+                '210 OK %d\n' % count + ''.join(lines[:count]))
+
+    def handle(self, message, address):
+        tag = ''
+        if message.startswith('@'):
+            tag, _, message = message.partition('\n')
+            tag += '\n'
+        lines = [x.strip() for x in message.splitlines()]
+        if not lines or not lines[0]:
+            return
+        if lines[0] in ('FLUSH', 'INVALIDATE'):
+            self._reply(address, tag, self._control(address, lines))
+        elif lines[0] == 'MULTI':
+            self._multi(address, tag, [x for x in lines[1:] if x])
+        else:
+            self.resolver.lookup(lines[0],
+                    lambda reply: self._reply(address, tag, reply))
+
+    def serve(self):
+        self.running = True
+        client = self.resolver.client
+        while self.running:
+            # wake up for the next hedge or retry, as Client.poll does
+            timeout = client.timeout
+            if client.events:
+                timeout = max(0, min(timeout,
+                    client.events[0][0] - time.time()))
+            try:
+                r, w, x = select.select([self.sock, client], [], [], timeout)
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+            client.poll(0)
+            while True:
+                try:
+                    message, address = self.sock.recvfrom(MAX_DATAGRAM)
+                except socket.error, e:
+                    if e.args[0] not in (errno.EAGAIN, errno.EINTR):
+                        logging.warning('error receiving: %s', e)
+                    break
+                try:
+                    self.handle(message, address)
+                except:
+                    logging.exception('error on %s:', address)
+        self.sock.close()
+        client.close()
+
+    def stop(self):
+        self.running = False
+
+
+def invalidate(caches, spans=None):
+    '''tells caching stubs at caches, a list of (host, port), to drop the
+numbers within spans, or everything if spans is None.  Fire and forget,
+a lost message only means the entries live until their ttl runs out.'''
+    messages = []
+    if spans is None:
+        messages.append('FLUSH\n')
+    else:
+        message = 'INVALIDATE\n'
+        for s, e in spans:
+            line = '%s %s\n' % (s, e)
+            if len(message) + len(line) > MAX_DATAGRAM:
+                messages.append(message)
+                message = 'INVALIDATE\n'
+            message += line
+        if len(message) > len('INVALIDATE\n'):
+            messages.append(message)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for address in caches:
+            for message in messages:
+                try:
+                    s.sendto(message, address)
+                except socket.error, e:
+                    logging.warning('invalidating cache %s:%s failed: %s',
+                            address[0], address[1], e)
+    finally:
+        s.close()
+
+
+def main():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] server-host")
+    op.add_option("-l", "--loglevel", help="loglevel (DEBUG, WARN)",
+        metavar="LOGLEVEL", default="INFO")
+    op.add_option("-p", "--port", help="local UDP port",
+        metavar="PORT", default=8989, type="int")
+    op.add_option("-b", "--bind-to", help="hostname to bind to",
+        metavar="HOST", default="localhost", dest="host")
+    op.add_option("-u", "--server-port", help="UDP port of the server",
+        metavar="PORT", default=8990, type="int")
+    op.add_option("-C", "--config-file",
+        help="use the server ports listed in [UDP] ports of CONFIG_FILE",
+        metavar="CONFIG_FILE", default="")
+    op.add_option("-c", "--cache-size", type="int",
+        help="number of answers cached", metavar="SIZE", default=100000)
+    op.add_option("-T", "--ttl", type="float",
+        help="seconds an answer is cached", metavar="TTL", default=300)
+    op.add_option("-n", "--negative-ttl", type="float",
+        help="seconds a miss is cached", metavar="TTL", default=30)
+    op.add_option("-t", "--timeout", type="float",
+        help="server timeout in seconds", metavar="TIMEOUT", default=1.0)
+    options, args = op.parse_args()
+    logger = logging.getLogger("")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+    logger.addHandler(handler)
+    if options.loglevel:
+        logger.setLevel(eval(options.loglevel, logging.__dict__))
+    if len(args) != 1:
+        op.error('incorrect number of arguments; required server host')
+    if options.config_file:
+        servers = servers_from_config(options.config_file, args[0])
+    else:
+        servers = [(args[0], options.server_port)]
+    resolver = CachingResolver(Client(servers, timeout=options.timeout),
+            options.cache_size, options.ttl, options.negative_ttl)
+    server = CacheServer(resolver, options.host, options.port)
+    def sighandler(signum, frame):
+        logging.info("received SIGTERM, shutting down.")
+        server.stop()
+    signal.signal(signal.SIGTERM, sighandler)
+    logging.info("caching numbex lookups on port %s", options.port)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+    logging.info("%s", ', '.join('%s %s' % x
+        for x in sorted(resolver.counts.items())))
+
+
+if __name__ == '__main__':
+    main()
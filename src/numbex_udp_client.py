@@ -3,17 +3,24 @@ import socket, traceback
 import logging
 import csv
 import sys
+import time
+import errno
+import heapq
+import random
+import select
+import threading
+from collections import deque
+
+import wireproto
+
+# keep requests small enough not to be fragmented
+MAX_DATAGRAM = 1400
 
 class UDPServerException(Exception):
     def __init__(*args, **kwargs):
         Exception.__init__(*args, **kwargs)
 
-def query_server(number, host, port, timeout=1.0):
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.settimeout(timeout)
-    s.sendto(number, (host, port))
-    message, address = s.recvfrom(1400)
-    s.close()
+def _parse_reply(message):
     if message.startswith('200'):
         return message.splitlines()[1].strip()
     elif message.startswith('404'):
@@ -21,21 +28,478 @@ def query_server(number, host, port, timeout=1.0):
     else:
         raise UDPServerException(message)
 
+def query_server(number, host, port, timeout=1.0):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(timeout)
+    s.sendto(number, (host, port))
+    message, address = s.recvfrom(MAX_DATAGRAM)
+    s.close()
+    return _parse_reply(message)
+
+def _make_batch(numbers):
+    request = 'MULTI\n'
+    count = 0
+    for n in numbers:
+        if count and len(request) + len(n) + 1 > MAX_DATAGRAM:
+            break
+        request += n + '\n'
+        count += 1
+    return request, count
+
+def _parse_multi(message):
+    lines = message.splitlines()
+    header = lines[0].split()
+    if len(header) != 3 or header[0] != '210':
+        raise UDPServerException(message)
+    count = int(header[2])
+    results = []
+    for line in lines[1:count+1]:
+        if line.startswith('200'):
+            results.append(line[4:].strip())
+        elif line.startswith('404'):
+            results.append(None)
+        else:
+            results.append(UDPServerException(line))
+    if len(results) != count:
+        raise UDPServerException('truncated reply: %s' % message)
+    return results
+
+def query_many(numbers, host, port, timeout=1.0):
+    '''resolves several numbers using as few datagrams as possible.
+returns a list in the order of numbers with the record for every number
+found, None for numbers not found and an UDPServerException instance
+for numbers the server couldn't handle'''
+    numbers = list(numbers)
+    results = []
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(timeout)
+    try:
+        while len(results) < len(numbers):
+            request, count = _make_batch(numbers[len(results):])
+            s.sendto(request, (host, port))
+            message, address = s.recvfrom(MAX_DATAGRAM)
+            # the server answers only as many numbers as fit in its reply
+            answered = _parse_multi(message)
+            if not answered:
+                raise UDPServerException('server answered no numbers')
+            results.extend(answered)
+    finally:
+        s.close()
+    return results
+
+def query_binary(numbers, host, port, timeout=1.0, flags=0):
+    '''query_many over the binary protocol, see wireproto.  Records are
+(start, end, sip, owner, date, signature) tuples, date and signature
+are None unless asked for with wireproto.DATE and wireproto.SIGNATURE
+in flags'''
+    numbers = list(numbers)
+    results = [None] * len(numbers)
+    todo = []
+    for i, number in enumerate(numbers):
+        try:
+            todo.append((i, wireproto.encode_number(number)))
+        except ValueError, e:
+            results[i] = UDPServerException('500 %s\n' % e)
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.settimeout(timeout)
+    try:
+        while todo:
+            rid = random.randrange(1 << 32)
+            request, count = wireproto.encode_request(rid,
+                    [n for i, n in todo], flags)
+            s.sendto(request, (host, port))
+            while True:
+                message, address = s.recvfrom(MAX_DATAGRAM)
+                try:
+                    status, version, rflags, rrid, entries = \
+                            wireproto.decode_response(message)
+                except wireproto.WireError, e:
+                    raise UDPServerException(str(e))
+                # a late reply to an earlier request
+                if rrid == rid:
+                    break
+            if status == wireproto.BAD_VERSION:
+                raise UDPServerException('server speaks version %s' % version)
+            elif status == wireproto.BUSY:
+                raise UDPServerException('503 Too many requests\n')
+            elif status != wireproto.OK or not entries:
+                raise UDPServerException('server answered no numbers')
+            for (i, n), (kind, record) in zip(todo, entries):
+                if kind == wireproto.HIT:
+                    results[i] = record
+                elif kind == wireproto.MALFORMED:
+                    results[i] = UDPServerException('500 invalid number\n')
+            todo = todo[len(entries):]
+    finally:
+        s.close()
+    return results
+
+def _parse_line(line):
+    if line.startswith('200'):
+        return line[4:]
+    elif line.startswith('404'):
+        return None
+    return UDPServerException(line)
+
+def query_stream(numbers, host, port, timeout=None):
+    '''resolves numbers over the server's TCP endpoint, sending them
+while reading the answers; yields (number, result) in order with results
+as in query_many'''
+    s = socket.create_connection((host, port), timeout)
+    numbers = iter(numbers)
+    sent = deque()
+    errors = []
+    def send():
+        try:
+            buf = []
+            for number in numbers:
+                number = number.strip()
+                if not number:
+                    continue
+                sent.append(number)
+                buf.append(number + '\n')
+                if len(buf) >= 1000:
+                    s.sendall(''.join(buf))
+                    buf = []
+            s.sendall(''.join(buf))
+            s.shutdown(socket.SHUT_WR)
+        except Exception, e:
+            errors.append(e)
+            s.shutdown(socket.SHUT_RDWR)
+    t = threading.Thread(target=send)
+    t.daemon = True
+    t.start()
+    try:
+        for line in s.makefile('rb'):
+            yield sent.popleft(), _parse_line(line.rstrip('\n'))
+    finally:
+        t.join()
+        s.close()
+    if errors:
+        raise errors[0]
+    if sent:
+        raise UDPServerException('connection closed with %s numbers '
+                'unanswered' % len(sent))
+
+
+def servers_from_config(confname, host):
+    '''the (host, port) of every port in [UDP] ports of confname'''
+    from defaultconf import read_config
+    cfg = read_config(confname)
+    return [(host, int(p)) for p in cfg.get('UDP', 'ports').split()]
+
+
+class ServerStats(object):
+    '''round trip times and health of one server as seen by a Client'''
+    def __init__(self, samples=64):
+        self.rtts = deque(maxlen=samples)
+        self.p95 = None
+        self.fresh = 0 # samples since p95 was computed
+        self.failures = 0 # timeouts in a row
+        self.ejected_until = 0
+
+    def add_rtt(self, rtt):
+        self.rtts.append(rtt)
+        self.failures = 0
+        self.fresh += 1
+        if self.p95 is None or self.fresh >= 8:
+            rtts = sorted(self.rtts)
+            self.p95 = rtts[int(len(rtts) * 0.95)]
+            self.fresh = 0
+
+
+class _Request(object):
+    def __init__(self, rid, number, callback):
+        self.rid = rid
+        self.number = number
+        self.callback = callback
+        self.tries = 0
+        self.server = None
+        self.hedge = None
+        # server -> send time, None once sent there twice (an answer
+        # can't be told apart then)
+        self.sent = {}
+
+
+class Client(object):
+    '''UDP client keeping one socket for any number of queries in flight.
+
+Every request carries an id the server echoes back, so replies are
+matched to requests in whatever order they come.  Requests are spread
+round robin over servers; one not answered within timeout is sent again
+to the next server, at most retries times.
+
+With more than one server a request still unanswered after the 95th
+percentile of its server's round trip time is also sent to another
+server, and the first answer wins.  A server timing out eject_after
+times in a row gets no requests for eject_time seconds.  counts tells
+how often each of this happened.
+
+submit() and poll() never block longer than asked to, so the client can
+be driven from an event loop watching fileno(); query() and query_many()
+are the blocking interface built on them.'''
+    # don't hedge faster than this, nor before there are samples
+    min_hedge_delay = 0.001
+    min_samples = 8
+
+    def __init__(self, servers, timeout=1.0, retries=2, hedge=True,
+            eject_after=3, eject_time=10.0):
+        '''servers: list of (host, port)'''
+        # replies come from addresses, not names
+        self.servers = [(socket.gethostbyname(h), p) for h, p in servers]
+        if not self.servers:
+            raise ValueError('no servers given')
+        self.timeout = timeout
+        self.retries = retries
+        self.hedge = hedge
+        self.eject_after = eject_after
+        self.eject_time = eject_time
+        self.stats = dict((s, ServerStats()) for s in self.servers)
+        self.counts = dict.fromkeys(('sent', 'retried', 'hedged',
+            'hedge_won', 'timeout', 'ejected'), 0)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+        self.pending = {} # id -> _Request
+        # heap of (time, id, tries, hedge), hedge events fire before
+        # the deadline of the same try
+        self.events = []
+        self.next_id = random.randrange(1 << 30)
+        self.next_server = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+    def _pick(self, avoid=None):
+        '''next healthy server other than avoid, round robin'''
+        now = time.time()
+        servers = self.servers
+        for i in xrange(len(servers)):
+            server = servers[(self.next_server + i) % len(servers)]
+            if server != avoid and self.stats[server].ejected_until <= now:
+                self.next_server += i + 1
+                return server
+        if avoid is not None:
+            return None
+        # all ejected, keep going anyway
+        self.next_server += 1
+        return servers[self.next_server % len(servers)]
+
+    def _hedge_delay(self, server):
+        stats = self.stats[server]
+        if len(stats.rtts) < self.min_samples:
+            return None
+        return min(max(stats.p95, self.min_hedge_delay), self.timeout / 2.0)
+
+    def _send_to(self, req, server):
+        if server in req.sent:
+            req.sent[server] = None
+        else:
+            req.sent[server] = time.time()
+        self.counts['sent'] += 1
+        try:
+            self.sock.sendto('@%x\n%s' % (req.rid, req.number), server)
+        except socket.error, e:
+            # handled like a lost datagram
+            logging.debug('sending to %s failed: %s', server, e)
+
+    def _send(self, req):
+        req.server = self._pick()
+        req.hedge = None
+        req.tries += 1
+        now = time.time()
+        heapq.heappush(self.events, (now + self.timeout, req.rid, req.tries,
+            False))
+        if self.hedge and len(self.servers) > 1:
+            delay = self._hedge_delay(req.server)
+            if delay is not None:
+                heapq.heappush(self.events, (now + delay, req.rid, req.tries,
+                    True))
+        self._send_to(req, req.server)
+
+    def _finish(self, req, result):
+        del self.pending[req.rid]
+        req.callback(req.number, result)
+
+    def submit(self, number, callback):
+        '''sends a query; callback(number, result) is called from poll()
+with the record, None if the number wasn't found, or an exception
+instance (socket.timeout when no server answered).  returns the id'''
+        rid = self.next_id
+        self.next_id = (self.next_id + 1) & 0x7fffffff
+        req = _Request(rid, number, callback)
+        self.pending[rid] = req
+        self._send(req)
+        return rid
+
+    def _receive(self):
+        done = 0
+        while True:
+            try:
+                message, address = self.sock.recvfrom(MAX_DATAGRAM)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return done
+                # e.g. an ICMP error from a server that isn't running
+                logging.debug('receive failed: %s', e)
+                continue
+            if not message.startswith('@'):
+                continue
+            tag, _, message = message.partition('\n')
+            try:
+                req = self.pending.get(int(tag[1:], 16))
+            except ValueError:
+                continue
+            if req is None:
+                # answered already
+                continue
+            sent = req.sent.get(address)
+            if sent is not None:
+                self.stats[address].add_rtt(time.time() - sent)
+            if address == req.hedge:
+                self.counts['hedge_won'] += 1
+            try:
+                result = _parse_reply(message)
+            except UDPServerException, e:
+                result = e
+            self._finish(req, result)
+            done += 1
+
+    def _failed(self, server):
+        stats = self.stats[server]
+        stats.failures += 1
+        if stats.failures >= self.eject_after:
+            logging.info('server %s:%s timed out %s times, ejecting it',
+                    server[0], server[1], stats.failures)
+            stats.ejected_until = time.time() + self.eject_time
+            stats.failures = 0
+            self.counts['ejected'] += 1
+
+    def _expire(self):
+        done = 0
+        now = time.time()
+        events = self.events
+        while events and events[0][0] <= now:
+            when, rid, tries, hedge = heapq.heappop(events)
+            req = self.pending.get(rid)
+            if req is None or req.tries != tries:
+                continue
+            if hedge:
+                req.hedge = self._pick(avoid=req.server)
+                if req.hedge is not None:
+                    self.counts['hedged'] += 1
+                    self._send_to(req, req.hedge)
+                continue
+            self._failed(req.server)
+            if req.hedge is not None:
+                self._failed(req.hedge)
+            if req.tries > self.retries:
+                self.counts['timeout'] += 1
+                self._finish(req, socket.timeout('no reply for %s' %
+                    req.number))
+                done += 1
+            else:
+                self.counts['retried'] += 1
+                self._send(req)
+        return done
+
+    def poll(self, timeout=0):
+        '''waits at most timeout seconds for replies, calls the callbacks
+of answered and failed requests and sends overdue ones again.  returns
+the number of requests finished'''
+        if self.events:
+            timeout = max(0, min(timeout, self.events[0][0] - time.time()))
+        try:
+            r, w, x = select.select([self.sock], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            r = []
+        done = 0
+        if r:
+            done += self._receive()
+        return done + self._expire()
+
+    def query(self, number):
+        '''blocking lookup, returns the record or None'''
+        results = []
+        self.submit(number, lambda n, r: results.append(r))
+        while not results:
+            self.poll(self.timeout)
+        if isinstance(results[0], Exception):
+            raise results[0]
+        return results[0]
+
+    def query_many(self, numbers, window=256):
+        '''blocking lookup of numbers with at most window queries in
+flight; returns a list as numbex_udp_client.query_many does, with
+socket.timeout instances for numbers no server answered'''
+        numbers = list(numbers)
+        results = [None] * len(numbers)
+        state = {'sent': 0, 'done': 0}
+        def store(i):
+            def callback(number, result):
+                results[i] = result
+                state['done'] += 1
+            return callback
+        while state['done'] < len(numbers):
+            while state['sent'] < len(numbers) and \
+                    state['sent'] - state['done'] < window:
+                self.submit(numbers[state['sent']], store(state['sent']))
+                state['sent'] += 1
+            self.poll(self.timeout)
+        return results
+
 
 def main():
     from optparse import OptionParser
     op = OptionParser(usage="%prog [options]")
     op.add_option("-p", "--port", help="UDP destination port",
         metavar="PORT", default=8990, type="int", dest="port")
-    op.add_option("-t", "--timeout", help="timeout",
-        metavar="TIMEOUT", default=8990, type="int")
+    op.add_option("-t", "--timeout", help="timeout in seconds",
+        metavar="TIMEOUT", default=1.0, type="float")
+    op.add_option("-C", "--config-file",
+        help="spread queries over the ports listed in [UDP] ports of CONFIG_FILE",
+        metavar="CONFIG_FILE", default="")
+    op.add_option("-B", "--binary", action="store_true",
+        help="use the binary protocol", default=False)
+    op.add_option("-T", "--tcp", action="store_true",
+        help="resolve the numbers read from stdin over TCP", default=False)
     options, args = op.parse_args()
+    if options.tcp:
+        if len(args) != 1:
+            op.error('invalid number of arguments; expected host')
+        for number, r in query_stream(sys.stdin, args[0], options.port):
+            if isinstance(r, Exception):
+                print '%s,error,%s' % (number, str(r).strip())
+            elif r is None:
+                print '%s,not found' % number
+            else:
+                print '%s,%s' % (number, r)
+        return
     if len(args) != 2:
         op.error('invalid number of arguments; expected host and e.164 number')
     host = args[0]
     number = args[1]
     try:
-        r = query_server(number, host, options.port, timeout=options.timeout)
+        if options.binary:
+            r = query_binary([number], host, options.port,
+                    timeout=options.timeout,
+                    flags=wireproto.DATE|wireproto.SIGNATURE)[0]
+            if isinstance(r, Exception):
+                raise r
+            if r:
+                r = ','.join(r[:4] + (r[4].isoformat(), r[5]))
+        elif options.config_file:
+            client = Client(servers_from_config(options.config_file, host),
+                    timeout=options.timeout)
+            r = client.query(number)
+            client.close()
+        else:
+            r = query_server(number, host, options.port,
+                    timeout=options.timeout)
         if r:
             print r
         else:
@@ -6,115 +6,851 @@ import time
 import signal
 import sys
 import threading
+import os
+import errno
+import select
+import fcntl
+import SocketServer
+from collections import deque
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
 
-import quicksect
-
 import database
+import utils
+import wireproto
+from accesslog import AccessLog
+from ratelimit import RateLimiter
+from defaultconf import read_config
+from rangeindex import RangeIndex
+from prefixindex import PrefixIndex
+from snapshot import Snapshot, SnapshotError, write_snapshot
+
+# keep replies small enough not to be fragmented
+MAX_DATAGRAM = 1400
 
-def make_socket(host, port):
+# not exported by the python 2 socket module; the value is fixed on linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT',
+        sys.platform.startswith('linux') and 15 or None)
+
+def make_socket(host, port, reuse_port=False):
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise socket.error('SO_REUSEPORT not supported on this platform')
+        s.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
     s.bind((host, port))
     return s
 
-def make_interval_tree(db):
-    logging.info("refreshing interval tree")
-    data = db.get_data_all()
-    it = iter(data)
-    first = it.next()
+OK_HEADER = '200 OK\n'
+NOT_FOUND = '404 Not found\n'
+BUSY = '503 Too many requests\n'
+# access log status by the first character of a reply
+STATUS = {'2': 'hit', '4': 'miss', '5': 'malformed'}
+
+def format_record(r):
+    r = list(r)
+    if not isinstance(r[4], basestring):
+        r[4] = r[4].isoformat()
     sio = StringIO()
     c = csv.writer(sio)
-    c.writerow(first)
-    ivaltree = quicksect.IntervalNode(
-            quicksect.Feature(int(first[0]), int(first[1]),
-                info=first))
-    for e in it:
-        sio = StringIO()
-        c = csv.writer(sio)
-        c.writerow(e)
-        ivaltree = ivaltree.insert(quicksect.Feature(
-                int(e[0]), int(e[1]), info=e))
-    return ivaltree
-
-def serve_numbers_forever(db, host='', port=8990, use_intervals=30, dbname=None):
-    s = make_socket(host, port)
+    c.writerow(r)
+    return sio.getvalue().rstrip('\r\n')
+
+def make_reply(r):
+    return OK_HEADER + format_record(r) + '\n'
+
+
+class DatabaseIndex(object):
+    '''index interface answered straight from the database'''
+    def __init__(self, db, prefix=False):
+        self.db = db
+        self.prefix = prefix
+
+    def find(self, number):
+        r = self.db.get_range_for(number, self.prefix)
+        if r is not None:
+            return make_reply(r)
+        return None
+
+
+class Resolver(object):
+    '''turns queries into replies.  The index holds ready-made replies
+for every range, so a hit costs one lookup; recent misses and malformed
+numbers are remembered in a bounded LRU so they don't reach the index
+again until it changes.'''
+    def __init__(self, index, cache_size=10000):
+        self.cache_size = cache_size
+        self.state = (index, utils.LRUCache(cache_size))
+        # reply -> parsed record, for binary requests
+        self.records = utils.LRUCache(cache_size)
+
+    def get_index(self):
+        return self.state[0]
+
+    def set_index(self, index):
+        # a single assignment, so answer() sees either the old index with
+        # its cache or the new one with an empty cache
+        self.state = (index, utils.LRUCache(self.cache_size))
+
+    index = property(get_index, set_index)
+
+    def answer(self, number):
+        index, misses = self.state
+        reply = misses.get(number)
+        if reply is not None:
+            return reply
+        try:
+            reply = index.find(number)
+        except ValueError, e:
+            reply = '500 %s\n' % str(e).replace('\n', ' ')
+        if reply is None:
+            reply = NOT_FOUND
+        if reply[0] != '2':
+            misses.put(number, reply)
+        return reply
+
+    def answer_record(self, number):
+        '''the (kind, record) of number for wireproto.encode_response'''
+        reply = self.answer(number)
+        if reply[0] == '4':
+            return wireproto.MISS, None
+        elif reply[0] != '2':
+            return wireproto.MALFORMED, None
+        r = self.records.get(reply)
+        if r is None:
+            r = csv.reader([reply[len(OK_HEADER):]]).next()
+            self.records.put(reply, r)
+        return wireproto.HIT, r
+
+    def answer_line(self, number):
+        '''the status line for number in a MULTI reply'''
+        reply = self.answer(number)
+        if reply[0] == '2':
+            return '200 ' + reply[len(OK_HEADER):]
+        elif reply[0] == '4':
+            return '404 %s\n' % number
+        return reply
+
+
+def answer_many(numbers, resolver, access=None, size=MAX_DATAGRAM):
+    '''builds the reply to a MULTI request: a "210 OK <count>" header
+followed by one status line per number, in request order.  Only as many
+numbers are answered as fit in size bytes, count tells how many.
+returns the reply and the count'''
+    total = len('210 OK %d\n' % len(numbers))
+    lines = []
+    for number in numbers:
+        line = resolver.answer_line(number)
+        total += len(line)
+        if total > size:
+            break
+        lines.append(line)
+        if access is not None:
+            access.count(STATUS[line[0]])
+    return '210 OK %d\n' % len(lines) + ''.join(lines), len(lines)
+
+# access log status by wireproto entry kind
+KIND_STATUS = {wireproto.HIT: 'hit', wireproto.MISS: 'miss',
+        wireproto.MALFORMED: 'malformed'}
+
+def answer_binary(message, address, resolver, access):
+    '''handle_message for wireproto requests'''
+    start = time.clock()
+    try:
+        version, flags, rid, numbers = wireproto.decode_request(message)
+    except wireproto.WireError:
+        # not even an id to answer to
+        access.count('malformed')
+        return None, 0
+    if version != wireproto.VERSION:
+        return wireproto.encode_error(rid, wireproto.BAD_VERSION), 0
+    entries = [resolver.answer_record('+%d' % n) for n in numbers]
+    reply, answered = wireproto.encode_response(rid, entries, flags)
+    for kind, r in entries[:answered]:
+        access.count(KIND_STATUS[kind])
+    access.record(address, 'BINARY %s of %s' % (answered, len(numbers)),
+            'batch', time.clock()-start)
+    return reply, answered
+
+def make_index(db, prefix=False):
+    '''prefix: build a PrefixIndex for longest-prefix lookups instead of
+a RangeIndex'''
+    logging.info("refreshing range index")
+    if prefix:
+        cls = PrefixIndex
+    else:
+        cls = RangeIndex
+    return cls((r[0], r[1], make_reply(r))
+            for r in db.iter_data_all(raw_dates=True))
+
+
+class IndexUpdater(object):
+    '''keeps a range index in sync with the database by following the
+range change journal; rebuilds from scratch only when the journal
+can't be used'''
+    def __init__(self, db, max_changes=10000, prefix=False):
+        self.db = db
+        self.max_changes = max_changes
+        self.prefix = prefix
+        self.version = None
+        self.seq = None
+
+    def build(self):
+        self.version = self.db.data_version()
+        # read before the data, a change in between is just applied twice
+        self.seq = self.db.get_journal_seq()
+        return make_index(self.db, self.prefix)
+
+    def load(self, path):
+        '''resumes from a snapshot file, returns an up to date index'''
+        try:
+            snap = Snapshot(path)
+        except (EnvironmentError, SnapshotError), e:
+            logging.info("can't use snapshot (%s), building the index", e)
+            return self.build()
+        logging.info("loaded snapshot %s, %s ranges", path, len(snap))
+        self.version = None
+        self.seq = snap.seq
+        return self.update(snap)
+
+    def update(self, index):
+        '''returns index itself if nothing changed, an updated copy
+otherwise'''
+        version = self.db.data_version()
+        if version is not None and version == self.version:
+            return index
+        self.version = version
+        seq = self.db.get_journal_seq()
+        if seq == self.seq:
+            return index
+        if seq < self.seq:
+            logging.info("journal is behind the index, full rebuild")
+            return self.build()
+        spans = self.db.get_journal_since(self.seq, self.max_changes)
+        if spans is None:
+            logging.info("too many changes or journal pruned, full rebuild")
+            return self.build()
+        ranges = []
+        for s, e in spans:
+            ranges.extend((r[0], r[1], make_reply(r))
+                    for r in self.db.get_data_overlapping(s, e))
+        try:
+            index = index.patched(spans, ranges)
+        except ValueError, e:
+            logging.warning("applying changes failed (%s), full rebuild", e)
+            return self.build()
+        logging.info("applied %s range changes", len(spans))
+        self.seq = seq
+        return index
+
+def handle_message(message, address, resolver, access):
+    '''returns the reply to a datagram and the number of queries it
+answered, or (None, 0) if it should be ignored.
+
+a request whose first line is "@<id>" gets the same line in front of
+its reply, so clients can match replies to requests; binary requests
+are passed to answer_binary'''
+    if wireproto.is_binary(message):
+        return answer_binary(message, address, resolver, access)
+    tag = ''
+    if message.startswith('@'):
+        tag, _, message = message.partition('\n')
+        tag += '\n'
+    if not message.strip():
+        return None, 0
+    lines = message.splitlines()
+    message = lines[0].strip()
+    start = time.clock()
+    if message == 'MULTI':
+        numbers = [x.strip() for x in lines[1:] if x.strip()]
+        # the tag goes into the same datagram
+        reply, answered = answer_many(numbers, resolver, access,
+                MAX_DATAGRAM - len(tag))
+        access.record(address, 'MULTI %s of %s' % (answered, len(numbers)),
+                'batch', time.clock()-start)
+        return tag + reply, answered
+    reply = resolver.answer(message)
+    access.record(address, message, STATUS[reply[0]], time.clock()-start)
+    return tag + reply, 1
+
+def admit(message, address, limiter, access):
+    '''returns None if the request is within the limit of its source,
+otherwise the reply to send instead, '' to send none.  A MULTI or
+binary request costs one token per number, but at least one.'''
+    binary = wireproto.is_binary(message)
+    rid = None
+    cost = 1
+    if binary:
+        try:
+            rid, cost = wireproto.peek_request(message)
+        except wireproto.WireError:
+            pass
+    elif 'MULTI' in message[:64]:
+        # counted as handle_message reads it
+        body = message
+        if body.startswith('@'):
+            body = body.partition('\n')[2]
+        lines = body.splitlines()
+        if lines and lines[0].strip() == 'MULTI':
+            cost = len([x for x in lines[1:] if x.strip()])
+    if limiter.allow(address[0], max(cost, 1)):
+        return None
+    access.count('limited')
+    if limiter.drop:
+        return ''
+    if binary:
+        if rid is None:
+            return ''
+        return wireproto.encode_error(rid, wireproto.BUSY)
+    if message.startswith('@'):
+        return message.partition('\n')[0] + '\n' + BUSY
+    return BUSY
+
+def index_source(db, use_intervals=30, snapshot=None, prefix=False):
+    '''returns the index to serve, a function returning the next index
+given the current one (the same object if nothing changed) and how often
+to call it.  The function is None if the index is never refreshed; it
+is meant to run in its own thread.
+
+without a db the snapshot is served and remapped when its file is
+replaced; with one, use_intervals > 0 keeps an index in sync with the
+database (written to snapshot on every change if given), otherwise the
+database is queried directly'''
+    if db is None:
+        def remap(index):
+            if index.changed():
+                logging.info("snapshot reloaded")
+                return Snapshot(index.path)
+            return index
+        return Snapshot(snapshot), remap, 1
+    if use_intervals <= 0:
+        return DatabaseIndex(db, prefix), None, 0
+    updater = IndexUpdater(db, prefix=prefix)
+    updater.thread = threading.current_thread()
+    if snapshot is not None:
+        index = updater.load(snapshot)
+        write_snapshot(snapshot, index, updater.seq)
+    else:
+        index = updater.build()
+    def update(index):
+        if updater.thread != threading.current_thread():
+            # data_version is per connection, and so per thread
+            updater.thread = threading.current_thread()
+            updater.version = None
+        new = updater.update(index)
+        if new is not index and snapshot is not None:
+            write_snapshot(snapshot, new, updater.seq)
+        return new
+    logging.info("update database period %ss", use_intervals)
+    return index, update, use_intervals
+
+def start_refresh(index, refresh, interval, install):
+    '''calls refresh(index) every interval seconds in a thread, passing
+every new index to install(); returns an event stopping the thread'''
+    stop = threading.Event()
+    def run():
+        current = index
+        while not stop.isSet():
+            stop.wait(interval)
+            if stop.isSet():
+                break
+            try:
+                new = refresh(current)
+            except:
+                logging.exception("index refresh failed")
+                continue
+            if new is not current:
+                current = new
+                install(new)
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+    return stop
+
+def serve_numbers_forever(db, host='', port=8990, use_intervals=30,
+        index=None, reuse_port=False, cache_size=10000, access=None,
+        snapshot=None, prefix=False, tcp_port=None, limiter=None):
+    '''index: serve from this index and never refresh it (used by
+supervisor workers, db may be None then)
+access: AccessLog, a default one is made if not given
+snapshot: snapshot file name, see index_source
+prefix: resolve numbers by longest prefix, see prefixindex
+tcp_port: also serve bulk lookups over TCP on this port
+limiter: RateLimiter applied to every source address'''
+    if access is None:
+        access = AccessLog()
+    if limiter is not None:
+        access.limiter = limiter
+    access.start()
+    s = make_socket(host, port, reuse_port)
     def sighandler(signum, frame):
         logging.info("received SIGTERM, shutting down.")
         raise SystemExit
     signal.signal(signal.SIGTERM, sighandler)
     logging.info("starting UDP numbex server on port %s", port)
     processed = 0
-    if use_intervals > 0:
-        treeref = [make_interval_tree(db)]
-        def update_tree():
-            mydb = database.Database(dbname)
-            logging.info("update database period %ss", use_intervals)
-            while True:
-                time.sleep(use_intervals)
-                treeref[0] = make_interval_tree(mydb)
-        t = threading.Thread(target=update_tree)
-        t.daemon = True
-        t.start()
-
-
-    while 1:
+    refresh_stop = None
+    if index is not None:
+        resolver = Resolver(index, cache_size)
+    else:
+        index, refresh, interval = index_source(db, use_intervals,
+                snapshot, prefix)
+        if refresh is None:
+            # nothing tells us when the database changes, don't cache
+            cache_size = 0
+        resolver = Resolver(index, cache_size)
+        if refresh is not None:
+            refresh_stop = start_refresh(index, refresh, interval,
+                    resolver.set_index)
+    if tcp_port:
+        start_stream_server(resolver, host, tcp_port, access)
+
+    try:
+        while 1:
+            try:
+                message, address = s.recvfrom(MAX_DATAGRAM)
+                if limiter is not None:
+                    reply = admit(message, address, limiter, access)
+                    if reply is not None:
+                        if reply:
+                            s.sendto(reply, address)
+                        continue
+                reply, answered = handle_message(message, address, resolver,
+                        access)
+                if reply is not None:
+                    s.sendto(reply, address)
+                    processed += answered
+
+            except (KeyboardInterrupt, SystemExit):
+                s.close()
+                access.stop()
+                logging.info("%s queries processed", processed)
+                sys.exit(0)
+            except socket.error, e:
+                s.close()
+                s = make_socket(host, port, reuse_port)
+                access.count('error')
+                logging.exception('error on %s: %s', address, e)
+            except:
+                access.count('error')
+                logging.exception('error on %s:', address)
+                try:
+                    s.sendto("500 Internal error\n", address)
+                except socket.error:
+                    s.close()
+                    s = make_socket(host, port, reuse_port)
+                    logging.exception('error on %s: %s', address, e)
+    finally:
+        if refresh_stop is not None:
+            refresh_stop.set()
+
+
+class StreamHandler(SocketServer.BaseRequestHandler):
+    '''answers a stream of newline separated numbers with one status
+line per number, as in a MULTI reply, in the same order.  Empty lines
+are skipped.
+
+the input is read chunk_size bytes at a time and the answers to a chunk
+are written out before the next one is read, so a client not reading
+its answers is stopped by TCP flow control instead of growing buffers
+here.'''
+    chunk_size = 65536
+    max_line = 1024
+
+    def handle(self):
+        sock = self.request
+        access = self.server.access
+        rest = ''
+        while True:
+            data = sock.recv(self.chunk_size)
+            if data:
+                lines = (rest + data).split('\n')
+                rest = lines.pop()
+                if len(rest) > self.max_line:
+                    sock.sendall('500 line too long\n')
+                    return
+            else:
+                lines, rest = [rest], ''
+            # the shared resolver's cache isn't thread safe, use the
+            # current index without one
+            resolver = Resolver(self.server.resolver.index, 0)
+            out = []
+            counts = dict.fromkeys(('hit', 'miss', 'malformed'), 0)
+            for line in lines:
+                number = line.strip()
+                if number:
+                    reply = resolver.answer_line(number)
+                    counts[STATUS[reply[0]]] += 1
+                    out.append(reply)
+            for status, n in counts.iteritems():
+                access.count(status, n)
+            if out:
+                sock.sendall(''.join(out))
+            if not data:
+                return
+
+
+class StreamServer(SocketServer.ThreadingTCPServer):
+    '''TCP endpoint for bulk lookups, one thread per connection; see
+StreamHandler'''
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, resolver, host='', port=8990, access=None):
+        SocketServer.ThreadingTCPServer.__init__(self, (host, port),
+                StreamHandler)
+        self.resolver = resolver
+        if access is None:
+            access = AccessLog()
+        self.access = access
+
+    def handle_error(self, request, client_address):
+        logging.exception('error on TCP connection from %s:', client_address)
+
+def start_stream_server(resolver, host='', port=8990, access=None):
+    '''runs a StreamServer in a thread, returns it'''
+    server = StreamServer(resolver, host, port, access)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    logging.info("serving bulk lookups on TCP port %s", port)
+    return server
+
+
+class EventServer(object):
+    '''serves every port from one select() loop in a single thread.
+
+Sockets are non-blocking; replies the kernel won't take right away are
+queued per socket and sent when it becomes writable.  A socket whose
+queue holds queue_size replies isn't read until the queue drains, so
+under overload the kernel drops requests instead of the server growing
+its backlog.  Index refreshes run in a separate thread and are handed
+over to the loop through a pipe, so a slow rebuild never stalls it.'''
+    # datagrams read from a socket before looking at the others again
+    read_batch = 64
+
+    def __init__(self, resolver, host='', ports=(8990,), reuse_port=False,
+            access=None, queue_size=1000, limiter=None):
+        self.resolver = resolver
+        self.limiter = limiter
+        if access is None:
+            access = AccessLog()
+        if limiter is not None:
+            access.limiter = limiter
+        self.access = access
+        self.queue_size = queue_size
+        self.sockets = []
+        for port in ports:
+            s = make_socket(host, port, reuse_port)
+            s.setblocking(0)
+            self.sockets.append(s)
+        self.pending = dict((s, deque()) for s in self.sockets)
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        for fd in (self.wakeup_r, self.wakeup_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.new_index = None
+        self.refresh_stop = None
+        self.running = False
+        self.processed = 0
+
+    def wakeup(self):
         try:
-            message, address = s.recvfrom(1400)
-            if not message.strip():
-                continue
-            message = message.splitlines()[0].strip()
-            logging.info("%s - QUERY %s", address, message)
-            start = time.clock()
-            if use_intervals > 0:
-                q = int(message)
-                r = treeref[0].find(q, q)
-                assert len(r) <= 1
-                if not r:
-                    r = None
+            os.write(self.wakeup_w, 'x')
+        except OSError, e:
+            # a full pipe will wake the loop anyway
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def install(self, index):
+        '''hands a new index over to the loop, callable from any thread'''
+        self.new_index = index
+        self.wakeup()
+
+    def refresh(self, refresh, interval):
+        '''see start_refresh'''
+        self.refresh_stop = start_refresh(self.resolver.index, refresh,
+                interval, self.install)
+
+    def stop(self):
+        '''makes serve() return, safe to call from a signal handler'''
+        self.running = False
+        self.wakeup()
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        index, self.new_index = self.new_index, None
+        if index is not None:
+            self.resolver.index = index
+
+    def _send(self, s, reply, address):
+        queue = self.pending[s]
+        if not queue:
+            try:
+                s.sendto(reply, address)
+                return
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.ENOBUFS):
+                    self.access.count('error')
+                    logging.warning('error sending to %s: %s', address, e)
+                    return
+        queue.append((reply, address))
+
+    def _flush(self, s):
+        queue = self.pending[s]
+        while queue:
+            reply, address = queue[0]
+            try:
+                s.sendto(reply, address)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.ENOBUFS):
+                    return
+                self.access.count('error')
+                logging.warning('error sending to %s: %s', address, e)
+            queue.popleft()
+
+    def _read(self, s):
+        queue = self.pending[s]
+        for i in xrange(self.read_batch):
+            if len(queue) >= self.queue_size:
+                return
+            try:
+                message, address = s.recvfrom(MAX_DATAGRAM)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return
+                self.access.count('error')
+                logging.warning('error receiving: %s', e)
+                return
+            if self.limiter is not None:
+                reply = admit(message, address, self.limiter, self.access)
+                if reply is not None:
+                    if reply:
+                        self._send(s, reply, address)
+                    continue
+            try:
+                reply, answered = handle_message(message, address,
+                        self.resolver, self.access)
+            except:
+                self.access.count('error')
+                logging.exception('error on %s:', address)
+                reply, answered = "500 Internal error\n", 0
+            if reply is not None:
+                self._send(s, reply, address)
+                self.processed += answered
+
+    def serve(self):
+        '''runs the loop until stop() is called'''
+        self.access.start()
+        self.running = True
+        while self.running:
+            readable = [s for s in self.sockets
+                    if len(self.pending[s]) < self.queue_size]
+            writable = [s for s in self.sockets if self.pending[s]]
+            try:
+                r, w, x = select.select(readable + [self.wakeup_r],
+                        writable, [])
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for s in w:
+                self._flush(s)
+            for s in r:
+                if s is self.wakeup_r:
+                    self._drain_wakeup()
                 else:
-                    r = r[0].info
-            else:
-                r = db.get_range_for(message.strip())
-            if r is not None:
-                r = list(r)
-                r[4] = r[4].isoformat()
-                sio = StringIO()
-                c = csv.writer(sio)
-                c.writerow(r)
-                end = time.clock()
-                s.sendto("200 OK\n"+sio.getvalue()+"\n", address)
-                logging.info("%s - QUERY completed in %.6f s", address, end-start)
-            else:
-                end = time.clock()
-                s.sendto("404 Not found\n", address)
-                logging.info("%s - QUERY not found in %.6f s", address, end-start)
-            processed += 1
+                    self._read(s)
+        self.close()
 
-        except (KeyboardInterrupt, SystemExit):
+    def close(self):
+        if self.refresh_stop is not None:
+            self.refresh_stop.set()
+        for s in self.sockets:
+            # best effort, don't wait for the kernel
+            self._flush(s)
             s.close()
-            logging.info("%s queries processed", processed)
-            sys.exit(0)
-        except socket.error, e:
-            s.close()
-            s = make_socket(host, port)
-            logging.exception('error on %s: %s', address, e)
-        except ValueError, e:
-            end = time.clock()
-            processed += 1
-            s.sendto("500 %s\n"%e, address)
-            logging.info("%s - QUERY malformed %.6f s", address, end-start)
-        except:
-            logging.exception('error on %s:')
+        os.close(self.wakeup_r)
+        os.close(self.wakeup_w)
+        self.access.stop()
+        logging.info("%s queries processed", self.processed)
+
+def serve_numbers_evented(db, host='', ports=(8990,), use_intervals=30,
+        reuse_port=False, cache_size=10000, access=None,
+        snapshot=None, prefix=False, tcp_port=None, limiter=None):
+    '''serve_numbers_forever for several ports at once, on an EventServer'''
+    index, refresh, interval = index_source(db, use_intervals, snapshot,
+            prefix)
+    if refresh is None:
+        cache_size = 0
+    server = EventServer(Resolver(index, cache_size), host, ports,
+            reuse_port, access, limiter=limiter)
+    def sighandler(signum, frame):
+        logging.info("received SIGTERM, shutting down.")
+        server.stop()
+    signal.signal(signal.SIGTERM, sighandler)
+    logging.info("starting UDP numbex server on ports %s",
+            ', '.join(str(p) for p in ports))
+    if refresh is not None:
+        server.refresh(refresh, interval)
+    if tcp_port:
+        start_stream_server(server.resolver, host, tcp_port, server.access)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        server.close()
+
+class Supervisor(object):
+    '''forks one worker process per port slot, all serving a copy of the
+same index built here; crashed workers are restarted.  When the index
+changes the workers are replaced one by one, or, with a snapshot file,
+the snapshot is rewritten and the workers remap it.
+
+A source may reach every worker, with SO_REUSEPORT by just changing its
+port, so each worker limits it to an equal share of limiter.'''
+    def __init__(self, db, host='', ports=(8990,), reuse_port=False,
+            use_intervals=30, cache_size=10000, log_sample=1.0,
+            stats_interval=60, snapshot=None, prefix=False, limiter=None):
+        self.host = host
+        self.ports = list(ports)
+        self.reuse_port = reuse_port
+        self.use_intervals = use_intervals
+        self.cache_size = cache_size
+        self.log_sample = log_sample
+        self.stats_interval = stats_interval
+        self.snapshot = snapshot
+        self.limiter = limiter
+        if limiter is not None and len(self.ports) > 1:
+            n = len(self.ports)
+            # at least one number per query must get through
+            self.limiter = RateLimiter(limiter.rate / n,
+                    max(limiter.burst / n, 1.0), limiter.max_sources,
+                    limiter.prune_interval, limiter.drop)
+            logging.info("each of %s workers allows %s queries/s, "
+                    "bursts of %s", n, self.limiter.rate,
+                    self.limiter.burst)
+        self.updater = IndexUpdater(db, prefix=prefix)
+        self.index = None
+        self.workers = {} # pid -> slot
+        self.started = {} # slot -> start time
+        self.running = False
+
+    def spawn(self, slot):
+        pid = os.fork()
+        if not pid:
             try:
-                s.sendto("500 Internal error\n", address)
-            except socket.error:
-                s.close()
-                s = make_socket(host, port)
-                logging.exception('error on %s: %s', address, e)
+                access = AccessLog(sample_rate=self.log_sample,
+                        stats_interval=self.stats_interval)
+                if self.snapshot is not None:
+                    # don't keep the supervisor's copy alive in the worker
+                    self.index = None
+                serve_numbers_forever(None, self.host, self.ports[slot],
+                        index=self.index, reuse_port=self.reuse_port,
+                        cache_size=self.cache_size, access=access,
+                        snapshot=self.snapshot, limiter=self.limiter)
+            except SystemExit:
+                os._exit(0)
+            except:
+                logging.exception("worker %s failed", slot)
+            os._exit(1)
+        logging.info("worker %s (pid %s) serving port %s", slot, pid,
+                self.ports[slot])
+        self.workers[pid] = slot
+        self.started[slot] = time.time()
+        return pid
+
+    def stop(self, pid):
+        slot = self.workers.pop(pid)
+        try:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        except OSError, e:
+            if e.errno not in (errno.ESRCH, errno.ECHILD):
+                raise
+        return slot
+
+    def roll(self):
+        '''replaces every worker with one serving the current index'''
+        for pid in self.workers.keys():
+            slot = self.workers[pid]
+            if self.reuse_port:
+                # the new worker can bind before the old one is gone
+                self.spawn(slot)
+                self.stop(pid)
+            else:
+                self.stop(pid)
+                self.spawn(slot)
+
+    def reap(self):
+        '''restarts workers that died, unless they did so right after
+starting (those are retried on the next call)'''
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            if not pid:
+                break
+            slot = self.workers.pop(pid, None)
+            if slot is not None:
+                logging.warning("worker %s (pid %s) died with status %s",
+                        slot, pid, status)
+        alive = set(self.workers.itervalues())
+        for slot in xrange(len(self.ports)):
+            if slot not in alive and time.time() - self.started[slot] > 1:
+                self.spawn(slot)
+
+    def run(self):
+        def sighandler(signum, frame):
+            logging.info("received SIGTERM, stopping workers.")
+            self.running = False
+        signal.signal(signal.SIGTERM, sighandler)
+        if self.snapshot is not None:
+            self.index = self.updater.load(self.snapshot)
+            write_snapshot(self.snapshot, self.index, self.updater.seq)
+        else:
+            self.index = self.updater.build()
+        for slot in xrange(len(self.ports)):
+            self.spawn(slot)
+        self.running = True
+        last_update = time.time()
+        try:
+            while self.running:
+                time.sleep(1)
+                if not self.running:
+                    break
+                self.reap()
+                if self.use_intervals > 0 and \
+                        time.time() - last_update >= self.use_intervals:
+                    last_update = time.time()
+                    try:
+                        index = self.updater.update(self.index)
+                    except:
+                        logging.exception("index refresh failed")
+                        continue
+                    if index is not self.index:
+                        self.index = index
+                        if self.snapshot is not None:
+                            write_snapshot(self.snapshot, index,
+                                    self.updater.seq)
+                        else:
+                            logging.info("index changed, restarting workers")
+                            self.roll()
+        except KeyboardInterrupt:
+            pass
+        for pid in self.workers.keys():
+            self.stop(pid)
+
 
 def main():
     from optparse import OptionParser
@@ -127,6 +863,43 @@ def main():
         metavar="HOST", default="", dest="host")
     op.add_option("-i", "--interval-tree", type="int", help="refresh (0 disables)",
         metavar="INTERVAL", default="30")
+    op.add_option("-C", "--config-file",
+        help="serve the ports listed in [UDP] ports of CONFIG_FILE",
+        metavar="CONFIG_FILE", default="")
+    op.add_option("-w", "--workers", type="int",
+        help="number of worker processes (default: one per port)",
+        metavar="N", default=0)
+    op.add_option("-r", "--reuse-port", action="store_true",
+        help="let workers share ports with SO_REUSEPORT", default=False)
+    op.add_option("-c", "--cache-size", type="int",
+        help="number of misses and malformed queries remembered",
+        metavar="SIZE", default=10000)
+    op.add_option("-s", "--log-sample", type="float",
+        help="fraction of queries written to the access log",
+        metavar="RATE", default=1.0)
+    op.add_option("-S", "--stats-interval", type="int",
+        help="log query counters every INTERVAL seconds (0 disables)",
+        metavar="INTERVAL", default=60)
+    op.add_option("-m", "--snapshot", action="store_true",
+        help="keep a memory-mapped snapshot of the index next to the database",
+        default=False)
+    op.add_option("-x", "--prefix", action="store_true",
+        help="resolve numbers by longest matching prefix", default=False)
+    op.add_option("-e", "--event-loop", action="store_true",
+        help="serve all ports from a single process with an event loop",
+        default=False)
+    op.add_option("-t", "--tcp-port", type="int",
+        help="serve bulk lookups over TCP on PORT (0 disables)",
+        metavar="PORT", default=0)
+    op.add_option("-R", "--rate-limit", type="float",
+        help="queries per second allowed from each source (0 disables)",
+        metavar="RATE", default=0)
+    op.add_option("-u", "--burst", type="float",
+        help="queries a source may send at once (default: RATE)",
+        metavar="N", default=None)
+    op.add_option("-D", "--drop-limited", action="store_true",
+        help="ignore queries over the limit instead of answering 503",
+        default=False)
     options, args = op.parse_args()
     logger = logging.getLogger("")
     handler = logging.StreamHandler()
@@ -140,8 +913,58 @@ def main():
         op.error('incorrect number of arguments; required database filename')
     else:
         db = database.Database(args[0])
-    serve_numbers_forever(db, options.host, options.port,
-            use_intervals=options.interval_tree, dbname=args[0])
+    if options.config_file:
+        cfg = read_config(options.config_file)
+        ports = [int(x) for x in cfg.get('UDP', 'ports').split()]
+    else:
+        ports = [options.port]
+    snapshot = None
+    if options.snapshot:
+        if options.prefix:
+            op.error('--snapshot and --prefix cannot be used together')
+        snapshot = args[0] + '.snap'
+    limiter = None
+    if options.rate_limit > 0:
+        limiter = RateLimiter(options.rate_limit, options.burst,
+                drop=options.drop_limited)
+        logging.info("limiting sources to %s queries/s, bursts of %s, %s",
+                limiter.rate, limiter.burst,
+                limiter.drop and "dropping the rest" or "refusing the rest")
+    if options.event_loop:
+        if options.workers:
+            op.error('--event-loop and --workers cannot be used together')
+        access = AccessLog(sample_rate=options.log_sample,
+                stats_interval=options.stats_interval)
+        serve_numbers_evented(db, options.host, ports,
+                use_intervals=options.interval_tree,
+                reuse_port=options.reuse_port,
+                cache_size=options.cache_size, access=access,
+                snapshot=snapshot, prefix=options.prefix,
+                tcp_port=options.tcp_port, limiter=limiter)
+        return
+    workers = options.workers or len(ports)
+    if workers > len(ports):
+        if not options.reuse_port:
+            op.error('more workers than ports; use --reuse-port')
+        ports = [ports[i % len(ports)] for i in xrange(workers)]
+    if len(ports) == 1 and not options.workers:
+        access = AccessLog(sample_rate=options.log_sample,
+                stats_interval=options.stats_interval)
+        serve_numbers_forever(db, options.host, ports[0],
+                use_intervals=options.interval_tree,
+                cache_size=options.cache_size, access=access,
+                snapshot=snapshot, prefix=options.prefix,
+                tcp_port=options.tcp_port, limiter=limiter)
+    else:
+        if options.tcp_port:
+            op.error('--tcp-port needs a single server process or --event-loop')
+        Supervisor(db, options.host, ports[:workers], options.reuse_port,
+                use_intervals=options.interval_tree,
+                cache_size=options.cache_size,
+                log_sample=options.log_sample,
+                stats_interval=options.stats_interval,
+                snapshot=snapshot, prefix=options.prefix,
+                limiter=limiter).run()
 
 
 if __name__ == '__main__':
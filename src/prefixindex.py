@@ -0,0 +1,108 @@
+from rangeindex import RangeIndex
+
+def digits_of(number):
+    '''"+4820" -> "4820"; raises ValueError for anything but digits'''
+    if isinstance(number, (int, long)):
+        number = str(number)
+    digits = number.strip().lstrip('+')
+    if not digits.isdigit():
+        raise ValueError("invalid number: %r" % number)
+    return digits
+
+def range_prefixes(start, end):
+    '''the smallest set of digit prefixes covering the numbers of each
+length in [start, end], as (length of the numbers, prefix) pairs, e.g.
+4820000-4820999 -> [(7, '4820')].  A prefix only stands for numbers of
+its length, so a shorter dialed number never matches it.
+
+>>> range_prefixes(4812380, 4812999)
+[(7, '481238'), (7, '481239'), (7, '48124'), (7, '48125'), (7, '48126'), (7, '48127'), (7, '48128'), (7, '48129')]
+>>> range_prefixes(98, 102)
+[(2, '98'), (2, '99'), (3, '100'), (3, '101'), (3, '102')]
+'''
+    start, end = int(start), int(end)
+    prefixes = []
+    for length in xrange(len(str(start)), len(str(end)) + 1):
+        lo = max(start, 10**(length-1))
+        hi = min(end, 10**length - 1)
+        while lo <= hi:
+            # widest block of 10**k numbers starting at lo inside [lo, hi]
+            k = 0
+            while k < length - 1 and lo % 10**(k+1) == 0 \
+                    and lo + 10**(k+1) - 1 <= hi:
+                k += 1
+            prefixes.append((length, str(lo)[:length-k]))
+            lo += 10**k
+    return prefixes
+
+
+class PrefixIndex(object):
+    '''longest-prefix lookup over number ranges.
+
+A range holds the numbers of each length between its start and end; a
+dialed number resolves to the range holding its longest prefix, so
+number blocks like +4820 match +48201234567 too, and a more specific
+block wins over a wider one.  This is what Database.get_range_for does
+with prefix=True.
+
+Every range is split into the digit prefixes covering it, kept in one
+dict under the length of the numbers they stand for, so +4820 and
++48200000-+48209999 don't share a key.  A lookup is one probe per
+prefix size in use for each length.
+
+>>> idx = PrefixIndex([('+4820', '+4820', 'a'), ('+4820500', '+4820599', 'b')])
+>>> idx.find('+48201234567'), idx.find('+48205501234'), idx.find('+4821')
+('a', 'b', None)
+'''
+    def __init__(self, ranges=()):
+        self.ranges = RangeIndex(ranges)
+        self.prefixes = {}
+        for s, e, v in self.ranges:
+            self._add(s, e, v)
+        self._update_lengths()
+
+    def _add(self, start, end, value):
+        for k in range_prefixes(start, end):
+            self.prefixes[k] = value
+
+    def _update_lengths(self):
+        sizes = {}
+        for length, p in self.prefixes:
+            sizes.setdefault(length, set()).add(len(p))
+        # [(number length, [prefix sizes])], longest first
+        self.lengths = sorted(((l, sorted(s, reverse=True))
+            for l, s in sizes.iteritems()), reverse=True)
+
+    def __len__(self):
+        return len(self.ranges)
+
+    def __iter__(self):
+        return iter(self.ranges)
+
+    def find(self, number):
+        '''returns the value of the longest prefix of number or None'''
+        digits = digits_of(number)
+        prefixes = self.prefixes
+        for length, sizes in self.lengths:
+            if length <= len(digits):
+                for size in sizes:
+                    v = prefixes.get((length, digits[:size]))
+                    if v is not None:
+                        return v
+        return None
+
+    def patched(self, spans, ranges):
+        '''see RangeIndex.patched'''
+        ranges = [(int(s), int(e), v) for s, e, v in ranges]
+        new = PrefixIndex()
+        new.ranges = self.ranges.patched(spans, ranges)
+        new.prefixes = dict(self.prefixes)
+        old = self.ranges
+        for s, e in spans:
+            for i in old._overlapping(int(s), int(e)):
+                for k in range_prefixes(old.starts[i], old.ends[i]):
+                    new.prefixes.pop(k, None)
+        for s, e, v in ranges:
+            new._add(s, e, v)
+        new._update_lengths()
+        return new
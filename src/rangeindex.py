@@ -0,0 +1,99 @@
+import bisect
+from array import array
+
+# python 2 arrays have no 'q' typecode; 'l' is 64 bits wide on LP64
+# platforms, elsewhere fall back to doubles, which represent every
+# 15-digit E.164 number exactly
+if array('l').itemsize >= 8:
+    _TYPECODE = 'l'
+else:
+    _TYPECODE = 'd'
+
+
+class RangeIndex(object):
+    '''static point lookup over non-overlapping number ranges.
+
+starts and ends are kept in two sorted arrays with a parallel list of
+values; a lookup is a single bisect over the starts column.
+
+>>> idx = RangeIndex([(10, 19, 'a'), (30, 30, 'b')])
+>>> idx.find(15), idx.find('+30'), idx.find(20)
+('a', 'b', None)
+'''
+    def __init__(self, ranges=()):
+        '''ranges: iterable of (start, end, value), start/end may be
+numbers or strings like '+481234' '''
+        rows = [(int(s), int(e), v) for s, e, v in ranges]
+        rows.sort(key=lambda x: x[0])
+        self.starts = array(_TYPECODE, [x[0] for x in rows])
+        self.ends = array(_TYPECODE, [x[1] for x in rows])
+        self.values = [x[2] for x in rows]
+        for i in xrange(1, len(rows)):
+            if self.starts[i] <= self.ends[i-1]:
+                raise ValueError("overlapping ranges: %s-%s and %s-%s" %
+                        (rows[i-1][0], rows[i-1][1], rows[i][0], rows[i][1]))
+
+    def __len__(self):
+        return len(self.values)
+
+    def _position(self, number):
+        i = bisect.bisect_right(self.starts, number) - 1
+        if i >= 0 and self.ends[i] >= number:
+            return i
+        return -1
+
+    def find(self, number):
+        '''returns the value of the range containing number or None'''
+        i = self._position(int(number))
+        if i < 0:
+            return None
+        return self.values[i]
+
+    def _overlapping(self, start, end):
+        # ranges don't overlap, so ends are sorted just like starts
+        return xrange(bisect.bisect_left(self.ends, start),
+                bisect.bisect_right(self.starts, end))
+
+    def patched(self, spans, ranges):
+        '''returns a copy of the index with every range overlapping one of
+spans removed and ranges (as in __init__) added; the values are shared'''
+        drop = set()
+        for s, e in spans:
+            drop.update(self._overlapping(int(s), int(e)))
+        adds = {}
+        for s, e, v in ranges:
+            adds[int(s)] = (int(s), int(e), v)
+        # inserts at a position go before the old range there is dropped
+        events = [(d, 1, None) for d in drop]
+        events.extend((bisect.bisect_left(self.starts, a[0]), 0, a)
+                for a in adds.itervalues())
+        events.sort()
+        new = RangeIndex()
+        starts, ends, values = new.starts, new.ends, new.values
+        pos = 0
+        for p, kind, add in events:
+            if p > pos:
+                starts.extend(self.starts[pos:p])
+                ends.extend(self.ends[pos:p])
+                values.extend(self.values[pos:p])
+                pos = p
+            if kind:
+                pos = p + 1
+            else:
+                starts.append(add[0])
+                ends.append(add[1])
+                values.append(add[2])
+        starts.extend(self.starts[pos:])
+        ends.extend(self.ends[pos:])
+        values.extend(self.values[pos:])
+        for s, e, v in adds.itervalues():
+            i = new._position(s)
+            if i < 0 or new.ends[i] != e \
+                    or (i > 0 and new.ends[i-1] >= s) \
+                    or (i+1 < len(starts) and starts[i+1] <= e):
+                raise ValueError("range %s-%s overlaps after patching" % (s, e))
+        return new
+
+    def __iter__(self):
+        for i in xrange(len(self.values)):
+            yield int(self.starts[i]), int(self.ends[i]), self.values[i]
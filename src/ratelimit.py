@@ -0,0 +1,72 @@
+import time
+import logging
+
+class RateLimiter(object):
+    '''token bucket per source address.
+
+every source may send rate queries per second on average and burst at
+once.  Buckets live in one dict of [tokens, last update] pairs; every
+prune_interval seconds the buckets that have filled up again are
+dropped, they'd behave the same as a new one.  New sources beyond
+max_sources aren't limited until a prune makes room, so a flood of
+spoofed addresses can't lock out legitimate clients.
+
+drop: whether servers should ignore refused queries instead of
+answering them with an error
+counts: limited (queries refused), untracked (queries let through with
+the table full), pruned (buckets dropped)'''
+    def __init__(self, rate, burst=None, max_sources=100000,
+            prune_interval=10, drop=False):
+        self.rate = float(rate)
+        self.drop = drop
+        if burst is None:
+            burst = rate
+        self.burst = float(burst)
+        self.max_sources = max_sources
+        self.prune_interval = prune_interval
+        self.buckets = {}
+        self.last_prune = time.time()
+        self.counts = dict.fromkeys(('limited', 'untracked', 'pruned'), 0)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, source, cost=1, now=None):
+        '''takes cost tokens from the bucket of source, returns False if
+there aren't enough'''
+        if now is None:
+            now = time.time()
+        if now - self.last_prune >= self.prune_interval:
+            self.prune(now)
+        bucket = self.buckets.get(source)
+        if bucket is None:
+            if len(self.buckets) >= self.max_sources:
+                self.counts['untracked'] += 1
+                return True
+            self.buckets[source] = bucket = [self.burst, now]
+        else:
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+            bucket[0] = tokens
+            bucket[1] = now
+        if bucket[0] < cost:
+            self.counts['limited'] += 1
+            return False
+        bucket[0] -= cost
+        return True
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        self.last_prune = now
+        # time after which any bucket is full
+        idle = self.burst / self.rate
+        stale = [k for k, (tokens, last) in self.buckets.iteritems()
+                if now - last >= idle]
+        for k in stale:
+            del self.buckets[k]
+        self.counts['pruned'] += len(stale)
+        if stale:
+            logging.debug("pruned %s rate limit buckets, %s left",
+                    len(stale), len(self.buckets))
@@ -23,42 +23,60 @@ def maketmprepo(name, keygetter):
     return repo
 
 
-def generatedata(n, owner="freeconet", keyfile="freeconet.priv.pem"):
+def generatedata(n, owner="freeconet", keyfile="freeconet.priv.pem",
+        processes=None):
+    '''n signed random ranges, signed on all cores (see sigbatch)'''
+    import sigbatch
     start = 48600000000
     end   = 48699999999
-    thissip = 'sip.freeconet.pl'
-    prevsip = 'new.freeconet.pl'
-    thisdate = datetime.datetime(2009, 2, 14, 12).isoformat()
-    prevdate = datetime.datetime(2009, 2, 15, 9).isoformat()
     from random import randrange
     # no duplicates
     points = list(set(randrange(start, end) for i in xrange(n)))
     points.sort()
-    first = ['+%s'%start,
-            '+%s'%points[0],
-            thissip,
-            owner,
-            thisdate]
-    from M2Crypto import DSA
-    dsa = DSA.load_key(keyfile)
-    first.append(crypto.sign_record(dsa, *first))
-    data = [first]
-    for i in xrange(n-1):
-        print i, i+1, len(points), points[i]
-        s = points[i]
-        e = points[i+1]-1
-        thissip, prevsip = prevsip, thissip
-        thisdate, prevdate = prevdate, thisdate
-        r = ['+%s'%s, '+%s'%e, thissip, owner, thisdate]
-        r.append(crypto.sign_record(dsa, *r))
-        data.append(r)
-    return data
+    def rows():
+        thissip = 'sip.freeconet.pl'
+        prevsip = 'new.freeconet.pl'
+        thisdate = datetime.datetime(2009, 2, 14, 12).isoformat()
+        prevdate = datetime.datetime(2009, 2, 15, 9).isoformat()
+        yield ['+%s'%start, '+%s'%points[0], thissip, owner, thisdate]
+        for i in xrange(n-1):
+            s = points[i]
+            e = points[i+1]-1
+            thissip, prevsip = prevsip, thissip
+            thisdate, prevdate = prevdate, thisdate
+            yield ['+%s'%s, '+%s'%e, thissip, owner, thisdate]
+    def progress(done):
+        print done, 'of', n
+    return list(sigbatch.sign_rows(rows(), file(keyfile).read(), processes,
+            progress=progress))
 
 def writecsv(data, ofile):
     out = csv.writer(ofile)
     for r in data:
         out.writerow(r)
 
+def benchindex(n=100000, lookups=100000):
+    '''compares build time and lookup rate of the interval and the prefix
+index on n random number blocks'''
+    import time
+    from random import randrange, sample
+    from rangeindex import RangeIndex
+    from prefixindex import PrefixIndex
+    blocks = sample(xrange(4860000, 4870000), n)
+    ranges = [('+%s0000'%b, '+%s9999'%b, b) for b in blocks]
+    numbers = ['+%s%04d' % (blocks[randrange(n)], randrange(10000))
+            for i in xrange(lookups)]
+    for cls in (RangeIndex, PrefixIndex):
+        t = time.time()
+        idx = cls(ranges)
+        built = time.time() - t
+        t = time.time()
+        for x in numbers:
+            idx.find(x)
+        took = time.time() - t
+        print '%s: built in %.3f s, %d lookups/s' % (cls.__name__, built,
+                lookups/took)
+
 
 class TestRepo(object):
     def setUp(self):
@@ -122,4 +140,38 @@ class TestRepo(object):
         os.system('rm -rf /tmp/testrepo1')
         os.system('rm -rf /tmp/testrepo2')
 
-
+def benchwire(n=20, rounds=2000):
+    '''compares the size of replies to n numbers and the time to build
+and parse them in the text (MULTI) and the binary protocol'''
+    import time
+    import wireproto
+    from numbex_udp_server import format_record
+    from numbex_udp_client import _parse_multi
+    records = [('+%s' % (48600000000 + i*100), '+%s' % (48600000099 + i*100),
+        'sip.freeconet.pl', 'freeconet', '2009-02-14T12:00:00.123456',
+        'dVfP+JcizPYALabkw9rCCVkjOFA= AQI=') for i in xrange(n)]
+    def text():
+        return '210 OK %d\n' % n + \
+                ''.join('200 %s\n' % format_record(r) for r in records)
+    entries = [(wireproto.HIT, r) for r in records]
+    def parse(message):
+        # binary replies come with the fields split
+        return [csv.reader([x]).next() for x in _parse_multi(message)]
+    forms = [('text', text, parse)]
+    for name, flags in (('binary', 0),
+            ('binary+date+sig', wireproto.DATE|wireproto.SIGNATURE)):
+        def encode(flags=flags):
+            return wireproto.encode_response(1, entries, flags)[0]
+        forms.append((name, encode, wireproto.decode_response))
+    for name, encode, decode in forms:
+        reply = encode()
+        t = time.time()
+        for i in xrange(rounds):
+            encode()
+        built = time.time() - t
+        t = time.time()
+        for i in xrange(rounds):
+            decode(reply)
+        parsed = time.time() - t
+        print '%s: %d bytes, build %.1f us, parse %.1f us per record' % (
+                name, len(reply), built/rounds/n*1e6, parsed/rounds/n*1e6)
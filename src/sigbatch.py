@@ -0,0 +1,222 @@
+'''checks and makes the signatures of many records on all cores.
+
+the rows are split into chunks handed to a multiprocessing pool, each
+with the PEM keys of its owners; workers parse each key on first use.
+Batches of a single chunk are checked in this process.
+
+a daemon calls start_pool() once, before it starts threads or opens
+database connections, so the workers are forked from a clean process
+and reused by every batch.  Without it every batch forks a pool of its
+own, which is fine for the command line tools.
+
+a memo, like Database, remembers the digests of records already found
+valid: memo.get_verified(digests) returns those of digests it knows,
+memo.add_verified(digests) records more.  A digest covers the record,
+its signature and every key of the owner, so it stays valid as long as
+none of them changes.
+
+sign_rows signs a stream of rows the same way, keeping their order.
+'''
+import hashlib
+import datetime
+import multiprocessing
+from collections import deque
+
+import crypto
+
+_pool = None
+_pool_size = 0
+
+def start_pool(processes=None):
+    '''starts the pool shared by check_signatures and sign_rows, of the
+number of cpus by default'''
+    global _pool, _pool_size
+    if _pool is None:
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        _pool = multiprocessing.Pool(processes)
+        _pool_size = processes
+    return _pool
+
+def stop_pool():
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.terminate()
+        _pool.join()
+        _pool = None
+        _pool_size = 0
+
+def _map(func, tasks, processes):
+    '''yields func(task) for each of tasks, in order, computed on the
+shared pool or a pool of processes.  Only a couple of tasks per process
+run ahead of what has been yielded, so little is wasted when the caller
+stops early.'''
+    pool = _pool
+    if pool is None:
+        pool = multiprocessing.Pool(processes)
+    else:
+        processes = _pool_size
+    pending = deque()
+    try:
+        tasks = iter(tasks)
+        while True:
+            for task in tasks:
+                pending.append(pool.apply_async(func, (task,)))
+                if len(pending) >= 2 * processes:
+                    break
+            if not pending:
+                break
+            yield pending.popleft().get()
+    finally:
+        if pool is not _pool:
+            # every task is either done or not wanted anymore
+            pool.terminate()
+            pool.join()
+
+def check_row(row, keys):
+    '''the signature of row (start, end, sip, owner, date, signature) is
+made by one of keys[owner], PEM strings'''
+    owner = row[3]
+    return any(crypto.check_signature(crypto.cached_pub_key(owner, k),
+            row[5], *row[:5])
+            for k in crypto.signature_keys(row[5], keys.get(owner, ())))
+
+def _check_chunk(task):
+    keys, rows = task
+    return [check_row(row, keys) for row in rows]
+
+def _check_serial(rows, keys, stop_on_failure):
+    result = []
+    for row in rows:
+        ok = check_row(row, keys)
+        result.append(ok)
+        if not ok and stop_on_failure:
+            break
+    return result
+
+# (pem, keyid) -> signer, in the workers
+_signers = {}
+
+def _make_signer(pem, keyid):
+    dsa = crypto.parse_priv_key(pem)
+    if keyid:
+        return dsa, crypto.dsa_key_id(dsa)
+    return dsa, None
+
+def _sign(signer, rows):
+    dsa, keyid = signer
+    signed = []
+    for row in rows:
+        row = list(row[:5])
+        if isinstance(row[4], datetime.datetime):
+            row[4] = row[4].isoformat()
+        row.append(crypto.sign_record(dsa, *row, keyid=keyid))
+        signed.append(row)
+    return signed
+
+def _sign_chunk(task):
+    pem, keyid, rows = task
+    signer = _signers.get((pem, keyid))
+    if signer is None:
+        signer = _signers[pem, keyid] = _make_signer(pem, keyid)
+    return _sign(signer, rows)
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def sign_rows(rows, pem, processes=None, chunk_size=500, keyid=True,
+        progress=None):
+    '''signs (start, end, sip, owner, date) rows with the PEM private key
+pem and yields them as lists with the signature appended and the date
+as an ISO 8601 string, in the order of rows.
+
+rows may be any iterable, only a couple of chunks per process are read
+ahead of what has been yielded.
+keyid: name the key in the signatures, see crypto.key_id
+progress: called with the number of rows signed so far after every
+chunk'''
+    if processes is None:
+        processes = _pool_size or multiprocessing.cpu_count()
+    done = 0
+    if processes <= 1:
+        signer = _make_signer(pem, keyid)
+        for chunk in _chunks(rows, chunk_size):
+            for row in _sign(signer, chunk):
+                yield row
+            done += len(chunk)
+            if progress is not None:
+                progress(done)
+        return
+    tasks = ((pem, keyid, chunk) for chunk in _chunks(rows, chunk_size))
+    for signed in _map(_sign_chunk, tasks, processes):
+        for row in signed:
+            yield row
+        done += len(signed)
+        if progress is not None:
+            progress(done)
+
+def record_digest(row, keyprint):
+    '''keyprint: key_print of the owner's keys'''
+    sig = row[5]
+    if isinstance(sig, unicode):
+        sig = sig.encode('utf-8')
+    return hashlib.sha1('\n'.join((crypto.make_csv_record(*row[:5]), sig,
+        keyprint))).hexdigest()
+
+def key_print(pems):
+    return hashlib.sha1('\n'.join(sorted(pems))).hexdigest()
+
+def check_signatures(rows, keys, processes=None, chunk_size=2000,
+        stop_on_failure=False, memo=None):
+    '''returns check_row(row, keys) for each of rows, in order.  With
+stop_on_failure the list ends at the first False and the rest of the
+rows is abandoned.
+
+processes: pool size, the number of cpus by default; 1 checks in this
+process, anything else uses the shared pool if there is one
+memo: rows it knows are not checked again, the valid ones are added'''
+    rows = list(rows)
+    if memo is None:
+        return _check(rows, keys, processes, chunk_size, stop_on_failure)
+    prints = dict((owner, key_print(pems)) for owner, pems in keys.items())
+    digests = [record_digest(row, prints.get(row[3], '')) for row in rows]
+    known = memo.get_verified(list(set(digests)))
+    todo = [i for i, d in enumerate(digests) if d not in known]
+    checked = _check([rows[i] for i in todo], keys, processes, chunk_size,
+            stop_on_failure)
+    memo.add_verified([digests[i] for i, ok in zip(todo, checked) if ok])
+    result = [True] * len(rows)
+    for i, ok in zip(todo, checked):
+        result[i] = ok
+    if stop_on_failure and not all(checked):
+        del result[todo[len(checked)-1]+1:]
+    return result
+
+def _check(rows, keys, processes, chunk_size, stop_on_failure):
+    if processes is None:
+        processes = _pool_size or multiprocessing.cpu_count()
+    if processes <= 1 or len(rows) <= chunk_size:
+        return _check_serial(rows, keys, stop_on_failure)
+    def tasks():
+        for i in xrange(0, len(rows), chunk_size):
+            chunk = rows[i:i+chunk_size]
+            owners = set(row[3] for row in chunk)
+            yield dict((o, keys[o]) for o in owners if o in keys), chunk
+    result = []
+    checks = _map(_check_chunk, tasks(), processes)
+    try:
+        for checked in checks:
+            if stop_on_failure and not all(checked):
+                result.extend(checked[:checked.index(False)+1])
+                break
+            result.extend(checked)
+    finally:
+        checks.close()
+    return result
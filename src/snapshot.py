@@ -0,0 +1,128 @@
+import os
+import mmap
+import struct
+
+from rangeindex import RangeIndex
+
+# file layout, all integers are little endian int64:
+#   magic, range count n, journal sequence number
+#   n range starts, sorted
+#   n range ends
+#   n+1 offsets into the heap, value i is heap[offset[i]:offset[i+1]]
+#   heap
+MAGIC = 'NBXSNAP1'
+_header = struct.Struct('<8sqq')
+_int64 = struct.Struct('<q')
+
+class SnapshotError(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+class _Int64Column(object):
+    'read-only sequence of int64 stored in a buffer'
+    def __init__(self, buf, offset, length):
+        self.buf = buf
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(self.length))]
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError(i)
+        return _int64.unpack_from(self.buf, self.offset + 8*i)[0]
+
+
+class _HeapColumn(object):
+    'read-only sequence of strings stored in a buffer'
+    def __init__(self, buf, offsets, heap):
+        self.buf = buf
+        self.offsets = offsets
+        self.heap = heap
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        start = self.heap + self.offsets[i]
+        return self.buf[start:self.heap + self.offsets[i+1]]
+
+
+class Snapshot(RangeIndex):
+    '''RangeIndex backed by a memory-mapped snapshot file, so every
+process mapping the same file shares one copy in the page cache.
+patched() returns an ordinary in-memory RangeIndex.'''
+    def __init__(self, path):
+        self.path = path
+        f = file(path, 'rb')
+        try:
+            self.stat = os.fstat(f.fileno())
+            if self.stat.st_size < _header.size:
+                raise SnapshotError('%s is too short' % path)
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, n, self.seq = _header.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise SnapshotError('%s is not a numbex snapshot' % path)
+        off = _header.size
+        self.starts = _Int64Column(self.map, off, n)
+        self.ends = _Int64Column(self.map, off + 8*n, n)
+        offsets = _Int64Column(self.map, off + 16*n, n + 1)
+        heap = off + 24*n + 8
+        if n and heap + offsets[n] != len(self.map):
+            raise SnapshotError('%s is truncated' % path)
+        self.values = _HeapColumn(self.map, offsets, heap)
+
+    def changed(self):
+        '''true if path has been replaced since the snapshot was opened'''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime) != \
+                (self.stat.st_ino, self.stat.st_mtime)
+
+
+def write_snapshot(path, index, seq=0):
+    '''writes the ranges of index (string values only) to path; the file
+is written under a temporary name and renamed, so readers see either
+the old or the new snapshot'''
+    starts = []
+    ends = []
+    offsets = [0]
+    values = []
+    for s, e, v in index:
+        starts.append(s)
+        ends.append(e)
+        values.append(v)
+        offsets.append(offsets[-1] + len(v))
+    n = len(starts)
+    tmp = '%s.tmp.%s' % (path, os.getpid())
+    f = file(tmp, 'wb')
+    try:
+        f.write(_header.pack(MAGIC, n, seq))
+        for column in (starts, ends, offsets):
+            for i in xrange(0, len(column), 65536):
+                chunk = column[i:i+65536]
+                f.write(struct.pack('<%sq' % len(chunk), *chunk))
+        for v in values:
+            f.write(v)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, path)
+    except:
+        f.close()
+        os.unlink(tmp)
+        raise
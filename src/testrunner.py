@@ -4,8 +4,16 @@ import logging
 
 from tests.test_gitdb import *
 from tests.test_crypto import *
+from tests.test_sigbatch import *
 from tests.test_database import *
 from tests.test_utils import *
+from tests.test_rangeindex import *
+from tests.test_snapshot import *
+from tests.test_prefixindex import *
+from tests.test_udp_cache import *
+from tests.test_wireproto import *
+from tests.test_ratelimit import *
+from tests.test_accesslog import *
 from tests.test_udp import *
 from tests.test_soap import *
 from tests.test_tracker import *
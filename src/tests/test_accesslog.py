@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+import unittest
+import logging
+import threading
+
+from accesslog import AccessLog
+from ratelimit import RateLimiter
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class TestAccessLog(unittest.TestCase):
+    def setUp(self):
+        self.log = logging.getLogger('test.access')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.handler = ListHandler()
+        self.log.addHandler(self.handler)
+
+    def tearDown(self):
+        self.log.removeHandler(self.handler)
+
+    def test_counters(self):
+        a = AccessLog(self.log, buffer_size=2)
+        for status in ('hit', 'hit', 'miss', 'malformed'):
+            a.record(('127.0.0.1', 1), '+48123', status, 0.0)
+        a.count('error')
+        self.assertEqual(len(a.buffer), 2)
+        a.flush()
+        self.assertEqual(len(self.handler.records), 2)
+        counts = a.report()
+        self.assertEqual(counts, dict(hit=2, miss=1, malformed=1, error=1,
+                batch=0, limited=0, dropped=2))
+        self.assertEqual(a.counts['hit'], 0)
+
+    def test_sampling(self):
+        a = AccessLog(self.log, sample_rate=0.0)
+        for i in range(10):
+            a.record(('127.0.0.1', 1), '+48123', 'hit', 0.0)
+        self.assertEqual(len(a.buffer), 0)
+        self.assertEqual(a.counts['hit'], 10)
+
+    def test_limiter(self):
+        a = AccessLog(self.log)
+        a.limiter = RateLimiter(10)
+        a.limiter.counts['pruned'] = 3
+        counts = a.report()
+        self.assertEqual((counts['untracked'], counts['pruned']), (0, 3))
+        self.assert_(self.handler.records[-1].endswith('untracked 0, pruned 3'))
+        a.limiter.counts['pruned'] = 5
+        self.assertEqual(a.report()['pruned'], 2)
+
+    def test_threads(self):
+        a = AccessLog(self.log)
+        def work():
+            for i in xrange(20000):
+                a.count('hit')
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for t in threads:
+            t.start()
+        total = 0
+        while any(t.is_alive() for t in threads):
+            total += a.report()['hit']
+        for t in threads:
+            t.join()
+        self.assertEqual(total + a.report()['hit'], 80000)
+
+
+if __name__ == '__main__':
+    unittest.main()
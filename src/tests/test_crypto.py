@@ -31,6 +31,36 @@ class TestSignatures(unittest.TestCase):
         self.assertFalse(crypto.check_signature(self.dsa, 'this is an invalid signature', *v))
         self.assertFalse(crypto.check_signature(self.dsa, 'not base64!', *v))
 
+    def test_key_id(self):
+        v = ['+48581234', '+48581999', 'sip.freeconet.pl', 'freeconet', datetime.datetime.now()]
+        keyid = crypto.dsa_key_id(self.dsa)
+        self.assertEqual(keyid, crypto.key_id(self.pubkey))
+        self.assertEqual(keyid, crypto.key_id(self.pubkey.replace('\n', '\r\n')))
+        sig = crypto.sign_record(self.dsa, *v, keyid=keyid)
+        self.assertEqual(sig.split()[2], keyid)
+        self.assert_(crypto.check_signature(self.dsa, sig, *v))
+        other = crypto.generate_dsa_key_pair(1024)[2]
+        self.assertEqual(crypto.signature_keys(sig, [other, self.pubkey]),
+                [self.pubkey])
+        # signatures without a key id are checked with every key
+        legacy = crypto.sign_record(self.dsa, *v)
+        self.assertEqual(crypto.signature_keys(legacy, [other, self.pubkey]),
+                [other, self.pubkey])
+        self.assert_(crypto.check_signature(self.dsa, legacy, *v))
+
+    def test_cached_pub_key(self):
+        dsapub = crypto.cached_pub_key('freeconet', self.pubkey)
+        self.assert_(crypto.cached_pub_key('freeconet',
+            unicode(self.pubkey)) is dsapub)
+        v = ['+48581234', '+48581999', 'sip.freeconet.pl', 'freeconet', datetime.datetime.now()]
+        self.assert_(crypto.check_signature(dsapub,
+            crypto.sign_record(self.dsa, *v), *v))
+        crypto.forget_pub_keys('other')
+        self.assert_(crypto.cached_pub_key('freeconet', self.pubkey) is dsapub)
+        crypto.forget_pub_keys('freeconet')
+        self.assert_(crypto.cached_pub_key('freeconet',
+            self.pubkey) is not dsapub)
+
 
 
 if __name__ == '__main__':
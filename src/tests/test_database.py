@@ -1,6 +1,10 @@
 from __future__ import absolute_import
 import unittest
 import datetime
+import threading
+import tempfile
+import shutil
+import os
 import database
 
 class TestDatabase(unittest.TestCase):
@@ -160,6 +164,196 @@ class TestDBUpdateData(unittest.TestCase):
         self.update_data_test(data, expected)
         self.singleTearDown()
 
+    def test_multi_row_overlap(self):
+        # the second row cuts the piece the first one left of the old range
+        self.singleSetUp()
+        data = [(u'+48581100', u'+48581199', u'new.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u'sig 1'),
+            (u'+48581500', u'+48581599', u'', u'freeconet',
+            datetime.datetime.now(), u''),
+            (u'+48581900', u'+48582100', u'new.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u'sig 2')]
+        expected = [
+        [u'+48581000',u'+48581099', u'sip.freeconet.pl',u'freeconet',None,u''],
+        [u'+48581100',u'+48581199', u'new.freeconet.pl',u'freeconet',None,u'sig 1'],
+        [u'+48581200',u'+48581499', u'sip.freeconet.pl',u'freeconet',None,u''],
+        [u'+48581600',u'+48581899', u'sip.freeconet.pl',u'freeconet',None,u''],
+        [u'+48581900',u'+48582100', u'new.freeconet.pl',u'freeconet',None,u'sig 2'],
+        ]
+        self.update_data_test(data, expected)
+        self.assertEqual(sorted(self.db.get_changed_data()), [
+            (u'A', u'+48581100', u'+48581199'),
+            (u'A', u'+48581200', u'+48581999'),
+            (u'A', u'+48581600', u'+48581999'),
+            (u'A', u'+48581900', u'+48582100'),
+            (u'M', u'+48581000', u'+48581999'),
+            (u'M', u'+48581200', u'+48581999'),
+            (u'M', u'+48581600', u'+48581999')])
+        self.singleTearDown()
+
+    def test_other_owner(self):
+        self.singleSetUp()
+        data = [(u'+48581100', u'+48581199', u'new.freeconet.pl',
+            u'other', datetime.datetime.now(), u'sig')]
+        self.failIf(self.db.update_data(data))
+        self.assertEqual(len(self.db.get_data_all()), 1)
+        self.singleTearDown()
+
+
+class TestDBJournal(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(':memory:', fill_example=False)
+        self.db.create_db()
+
+    def test_journal(self):
+        self.assertEqual(self.db.get_journal_seq(), 0)
+        data = [[u'+48581000', u'+48581999', u'sip.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u'']]
+        self.db.update_data(data)
+        seq = self.db.get_journal_seq()
+        self.assertEqual(self.db.get_journal_since(0),
+                [(u'+48581000', u'+48581999')])
+        data = [[u'+48581500', u'+48581599', u'new.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u'']]
+        self.db.update_data(data)
+        self.assertEqual(self.db.get_journal_since(seq),
+                [(u'+48581000', u'+48581999'), (u'+48581600', u'+48581999'),
+                 (u'+48581500', u'+48581599')])
+        self.assertEqual(self.db.get_journal_since(seq, limit=2), None)
+
+    def test_journal_pruned(self):
+        self.db.journal_keep = 1
+        for i in range(3):
+            data = [[u'+4858100%s'%i, u'+4858100%s'%i, u'sip.freeconet.pl',
+                u'freeconet', datetime.datetime.now(), u'']]
+            self.db.update_data(data)
+        self.db.clear_changed_data()
+        self.assertEqual(self.db.get_journal_seq(), 3)
+        self.assertEqual(self.db.get_journal_since(0), None)
+        self.assertEqual(self.db.get_journal_since(2),
+                [(u'+48581002', u'+48581002')])
+
+
+class TestDBMaxSpan(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(':memory:', fill_example=False)
+        self.db.create_db()
+        data = [[u'+48581000', u'+48581099', u'sip.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u''],
+            [u'+48582000', u'+48589999', u'sip.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u''],
+            [u'+48590000', u'+48590009', u'sip.freeconet.pl',
+            u'freeconet', datetime.datetime.now(), u'']]
+        self.db.update_data(data)
+
+    def max_span(self):
+        return list(self.db.conn.execute(
+            "select value from numbex_meta where name = 'max_span'"))[0][0]
+
+    def test_lookup(self):
+        self.assertEqual(self.max_span(), 7999)
+        self.assertEqual(self.db.get_range_for('+48589990')[0], u'+48582000')
+        self.assertEqual(self.db.get_range_for('+48581100'), None)
+        self.assertEqual(self.db.overlapping_ranges('+48581050', '+48582000'),
+                [(u'+48581000', u'+48581099'), (u'+48582000', u'+48589999')])
+
+    def test_upgrade(self):
+        self.db.conn.execute('drop table numbex_meta')
+        self.db.upgrade_db()
+        self.assertEqual(self.max_span(), 7999)
+        self.assertEqual(self.db.get_range_for('+48589990')[0], u'+48582000')
+
+
+class TestDBBulkLoad(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(':memory:', fill_example=False)
+        self.db.create_db()
+        now = datetime.datetime(2009, 1, 13, 23, 59, 30)
+        self.data = [[u'+48581000', u'+48581099', u'sip.freeconet.pl',
+            u'freeconet', now, u'sig 1'],
+            [u'+48581100', u'+48581199', u'', u'freeconet', now, u''],
+            [u'+48582000', u'+48589999', u'sip.freeconet.pl',
+            u'freeconet', now, u'sig 2']]
+
+    def test_load(self):
+        self.failUnless(self.db.bulk_load(self.data))
+        expected = [tuple(self.data[0]), tuple(self.data[2])]
+        self.assertEqual(self.db.get_data_all(), expected)
+        self.assertEqual(self.db.get_range_for('+48589990'), expected[1])
+        self.assertEqual(self.db.get_journal_since(0),
+                [(u'+48581000', u'+48589999')])
+        self.failIf(self.db.has_changed_data())
+        self.assertRaises(ValueError, self.db.bulk_load, self.data)
+
+    def test_overlap(self):
+        self.data[1][0] = u'+48581099'
+        self.failIf(self.db.bulk_load(self.data))
+        self.failUnless(self.db.ranges_empty())
+
+
+class TestDBIter(unittest.TestCase):
+    def setUp(self):
+        self.db = database.Database(':memory:', fill_example=False)
+        self.db.create_db()
+        self.db._populate_example_ranges(self.db.conn.cursor())
+
+    def test_iter(self):
+        data = self.db.get_data_all()
+        self.assertEqual(len(data), 4)
+        self.assertEqual(list(self.db.iter_data_all(batch=3)), data)
+        raw = [r[:4] + (r[4].isoformat(),) + r[5:] for r in data]
+        self.assertEqual(list(self.db.iter_data_all(batch=1,
+            raw_dates=True)), raw)
+        since = datetime.datetime(2009, 1, 5)
+        self.assertEqual(list(self.db.iter_data_since(since, batch=1,
+            raw_dates=True)), [r for r in raw if r[4] >= '2009-01-05'])
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = database.Database(os.path.join(self.dir, 'test.db'),
+                fill_example=False)
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dir)
+
+    def test_threads(self):
+        self.assertEqual(list(self.db.conn.execute('pragma journal_mode')),
+                [(u'wal',)])
+        conns = []
+        result = []
+        def other():
+            conns.append(self.db.conn)
+            self.failUnless(self.db.update_data([[u'+48581000',
+                u'+48581999', u'sip.freeconet.pl', u'freeconet',
+                datetime.datetime.now(), u'']]))
+            result.append(self.db.get_range_for('+48581500')[0])
+        t = threading.Thread(target=other)
+        t.start()
+        t.join()
+        self.assertEqual(result, [u'+48581000'])
+        self.failIf(conns[0] is self.db.conn)
+        self.failIf(self.db.pool.writer in conns + [self.db.conn])
+        self.assertEqual(self.db.get_range_for('+48581500')[0], u'+48581000')
+
+    def test_commit(self):
+        # a reader cursor passed in still writes through the writer
+        c = self.db.conn.cursor()
+        self.db.insert_range(c, u'+48581000', u'+48581999',
+                u'sip.freeconet.pl', u'freeconet', datetime.datetime.now(),
+                u'')
+        c.close()
+        self.assertEqual(self.db.get_range_for('+48581500'), None)
+        self.db.commit()
+        result = []
+        t = threading.Thread(target=lambda: result.append(
+            self.db.get_range_for('+48581500')[0]))
+        t.start()
+        t.join()
+        self.assertEqual(result, [u'+48581000'])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,93 @@
+from __future__ import absolute_import
+import unittest
+import datetime
+
+import database
+from prefixindex import PrefixIndex, range_prefixes
+
+class TestRangePrefixes(unittest.TestCase):
+    def test_block(self):
+        self.assertEqual(range_prefixes('+4820000', '+4820999'),
+                [(7, '4820')])
+        self.assertEqual(range_prefixes('+4820', '+4820'), [(4, '4820')])
+
+    def test_lengths(self):
+        self.assertEqual(range_prefixes(98, 102),
+                [(2, '98'), (2, '99'), (3, '100'), (3, '101'), (3, '102')])
+        self.assertEqual([p for l, p in range_prefixes(4812340, 4812999)],
+                ['481234', '481235', '481236', '481237', '481238', '481239',
+                 '48124', '48125', '48126', '48127', '48128', '48129'])
+
+
+class TestPrefixIndex(unittest.TestCase):
+    def setUp(self):
+        self.data = [('+48', '+48', 'pl'),
+                     ('+4820000', '+4820999', 'a'),
+                     ('+48205', '+48205', 'b'),
+                     ('+481234', '+481299', 'c')]
+        self.idx = PrefixIndex(self.data)
+
+    def test_find(self):
+        f = self.idx.find
+        self.assertEqual(f('+48123'), 'pl')
+        self.assertEqual(f('+48210'), 'pl')
+        self.assertEqual(f('+4820000'), 'a')
+        self.assertEqual(f('+482049912345'), 'a')
+        self.assertEqual(f('+482051'), 'b')
+        self.assertEqual(f('+48129912345'), 'c')
+        self.assertEqual(f('+49'), None)
+        self.assertEqual(f('+4'), None)
+        self.assertRaises(ValueError, f, '+48abc')
+
+    def test_patched(self):
+        new = self.idx.patched([('+48205', '+48205'), ('+481234', '+481299')],
+                [('+481200', '+481299', 'd')])
+        self.assertEqual(new.find('+4820512'), 'a')
+        self.assertEqual(new.find('+482051'), 'pl')
+        self.assertEqual(new.find('+481201'), 'd')
+        self.assertEqual(self.idx.find('+481201'), 'pl')
+
+    def test_shorter_number(self):
+        # 48129 is a prefix of the block, not a number in it
+        self.assertEqual(self.idx.find('+48129'), 'pl')
+        self.assertEqual(self.idx.find('+4812999'), 'c')
+
+    def test_same_prefix(self):
+        # both ranges are the 4820 block, for different number lengths
+        idx = PrefixIndex([('+4820', '+4820', 'short'),
+                ('+48200000', '+48209999', 'long')])
+        self.assertEqual(idx.find('+48201'), 'short')
+        self.assertEqual(idx.find('+48201234'), 'long')
+        new = idx.patched([('+48200000', '+48209999')], [])
+        self.assertEqual(new.find('+48201234'), 'short')
+        new = idx.patched([('+4820', '+4820')], [])
+        self.assertEqual(new.find('+48201'), None)
+        self.assertEqual(new.find('+48201234'), 'long')
+
+    def check_database(self, data, numbers):
+        idx = PrefixIndex(data)
+        db = database.Database(':memory:', fill_example=False)
+        db.create_db()
+        c = db.conn.cursor()
+        for s, e, sip in data:
+            db.insert_range(c, s, e, sip, u'freeconet',
+                    datetime.datetime.now(), u'', safe=False)
+        c.close()
+        for n in numbers:
+            r = db.get_range_for(n, prefix=True)
+            if r is None:
+                self.assertEqual(idx.find(n), None)
+            else:
+                self.assertEqual(r[2], idx.find(n))
+
+    def test_database(self):
+        self.check_database(self.data, ('+48123', '+4820000',
+            '+482049912345', '+482051', '+48129912345', '+49', '+4',
+            '+48129', '+4812', '+48205', '+4812999'))
+        self.check_database([('+4820', '+4820', 'short'),
+                ('+48200000', '+48209999', 'long')],
+                ('+4820', '+48201', '+4820123', '+48201234', '+482012345'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+import unittest
+
+from rangeindex import RangeIndex
+
+class TestRangeIndex(unittest.TestCase):
+    def setUp(self):
+        self.data = [('+4820000', '+4820999', 'a'),
+                     ('+481234', '+481299', 'b'),
+                     ('+4821000', '+4821111', 'c'),
+                     ('+4830000', '+4830000', 'd')]
+        self.idx = RangeIndex(self.data)
+
+    def test_edges(self):
+        for s, e, v in self.data:
+            self.assertEqual(self.idx.find(s), v)
+            self.assertEqual(self.idx.find(e), v)
+            self.assertEqual(self.idx.find(int(s)+(int(e)-int(s))//2), v)
+
+    def test_not_found(self):
+        for n in ('+481233', '+481300', '+4821112', '+4830001', '+1', '+0'):
+            self.assertEqual(self.idx.find(n), None)
+
+    def test_malformed(self):
+        self.assertRaises(ValueError, self.idx.find, 'tonienumer')
+
+    def test_sorted(self):
+        self.assertEqual([x[0] for x in self.idx],
+                [481234, 4820000, 4821000, 4830000])
+        self.assertEqual(len(self.idx), 4)
+
+    def test_overlap(self):
+        self.assertRaises(ValueError, RangeIndex,
+                [('+481000', '+481500', 'a'), ('+481500', '+481600', 'b')])
+
+    def test_patched(self):
+        # split +4820000..+4820999, drop +4830000, add +4840000..+4840099
+        spans = [('+4820000', '+4820999'), ('+4830000', '+4830000'),
+                 ('+4840000', '+4840099')]
+        ranges = [('+4820000', '+4820499', 'a1'), ('+4820500', '+4820999', 'a2'),
+                  ('+4840000', '+4840099', 'e')]
+        new = self.idx.patched(spans, ranges)
+        self.assertEqual(list(new), [(481234, 481299, 'b'),
+                (4820000, 4820499, 'a1'), (4820500, 4820999, 'a2'),
+                (4821000, 4821111, 'c'), (4840000, 4840099, 'e')])
+        self.assertEqual(new.find('+4820600'), 'a2')
+        self.assertEqual(new.find('+4830000'), None)
+        # the original is left alone
+        self.assertEqual(self.idx.find('+4830000'), 'd')
+
+    def test_patched_overlap(self):
+        self.assertRaises(ValueError, self.idx.patched,
+                [('+4820000', '+4820999')], [('+4820000', '+4821000', 'x')])
+
+    def test_empty(self):
+        self.assertEqual(RangeIndex().find('+48123'), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
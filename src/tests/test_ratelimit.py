@@ -0,0 +1,75 @@
+from __future__ import absolute_import
+import unittest
+
+import wireproto
+from ratelimit import RateLimiter
+from accesslog import AccessLog
+from numbex_udp_server import admit, BUSY
+
+class TestRateLimiter(unittest.TestCase):
+    def test_bucket(self):
+        rl = RateLimiter(10, burst=5)
+        for i in range(5):
+            self.assert_(rl.allow('a', now=100.0))
+        self.failIf(rl.allow('a', now=100.0))
+        # other sources have buckets of their own
+        self.assert_(rl.allow('b', now=100.0))
+        self.failIf(rl.allow('a', now=100.0625))
+        self.assert_(rl.allow('a', now=100.125))
+        self.failIf(rl.allow('a', cost=3, now=100.25))
+        self.assert_(rl.allow('a', cost=3, now=100.5))
+        self.assertEqual(3, rl.counts['limited'])
+
+    def test_prune(self):
+        rl = RateLimiter(10, burst=5, max_sources=2, prune_interval=1)
+        rl.last_prune = 100.0
+        rl.allow('a', now=100.0)
+        rl.allow('b', now=100.6)
+        # the table is full, c goes unlimited
+        for i in range(10):
+            self.assert_(rl.allow('c', now=100.6))
+        self.assertEqual(10, rl.counts['untracked'])
+        # a is full again and pruned, b is not
+        rl.allow('c', now=101.0)
+        self.assertEqual(['b', 'c'], sorted(rl.buckets))
+        self.assertEqual(1, rl.counts['pruned'])
+
+    def test_admit(self):
+        access = AccessLog()
+        rl = RateLimiter(1, burst=2)
+        address = ('10.0.0.1', 5060)
+        self.assertEqual(None, admit('+481234', address, rl, access))
+        self.assertEqual(BUSY, admit('MULTI\n+481234\n+481235\n', address,
+            rl, access))
+        self.assertEqual(None, admit('+481234', address, rl, access))
+        self.assertEqual('@1f\n' + BUSY, admit('@1f\n+481234', address, rl,
+            access))
+        request, count = wireproto.encode_request(7, [481234])
+        self.assertEqual(wireproto.BUSY,
+                wireproto.decode_response(admit(request, address, rl,
+                    access))[0])
+        rl.drop = True
+        self.assertEqual('', admit('+481234', address, rl, access))
+        self.assertEqual(4, access.counts['limited'])
+
+    def test_admit_cost(self):
+        access = AccessLog()
+        rl = RateLimiter(0.001, burst=10)
+        address = ('10.0.0.1', 5060)
+        def cost(message):
+            rl.buckets.clear()
+            admit(message, address, rl, access)
+            return int(round(10 - rl.buckets[address[0]][0]))
+        self.assertEqual(1, cost('+481234'))
+        self.assertEqual(2, cost('MULTI\n+481234\n+481235\n'))
+        # no trailing newline
+        self.assertEqual(2, cost('MULTI\n+481234\n+481235'))
+        self.assertEqual(1, cost('MULTI\n+481234'))
+        # the tag is not a number
+        self.assertEqual(2, cost('@1f\nMULTI\n+481234\n+481235\n'))
+        self.assertEqual(1, cost('MULTI\n\n+481234\n \n'))
+        self.assertEqual(1, cost('MULTI\n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
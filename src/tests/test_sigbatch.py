@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+import unittest
+import datetime
+
+import crypto
+import sigbatch
+import database
+
+class TestSigBatch(unittest.TestCase):
+    def setUp(self):
+        dsa, self.privkey, self.pubkey = crypto.generate_dsa_key_pair(1024)
+        now = datetime.datetime(2009, 1, 13, 23, 59, 30)
+        self.rows = []
+        for i in range(30):
+            r = ['+4858%04d' % (i*10), '+4858%04d' % (i*10+9),
+                    'sip.freeconet.pl', 'freeconet', now]
+            self.rows.append(r + [crypto.sign_record(dsa, *r)])
+        self.rows[17][2] = 'other.freeconet.pl'
+        self.rows[23][3] = 'nokeys'
+        self.keys = {'freeconet': [self.pubkey]}
+
+    def test_parallel(self):
+        serial = sigbatch.check_signatures(self.rows, self.keys, processes=1)
+        expected = [True] * 30
+        expected[17] = expected[23] = False
+        self.assertEqual(serial, expected)
+        self.assertEqual(sigbatch.check_signatures(self.rows, self.keys,
+            processes=2, chunk_size=4), serial)
+
+    def test_stop_on_failure(self):
+        for processes in (1, 2):
+            self.assertEqual(sigbatch.check_signatures(self.rows, self.keys,
+                processes=processes, chunk_size=4, stop_on_failure=True),
+                [True] * 17 + [False])
+
+    def test_sign_rows(self):
+        rows = [r[:5] for r in self.rows]
+        rows[3][4] = rows[3][4].isoformat()
+        for processes in (1, 2):
+            done = []
+            signed = list(sigbatch.sign_rows(iter(rows), self.privkey,
+                processes=processes, chunk_size=4, progress=done.append))
+            self.assertEqual([r[:4] for r in signed], [r[:4] for r in rows])
+            self.assertEqual(set(r[4] for r in signed),
+                    set([rows[3][4]]))
+            self.assertEqual(len(signed[0][5].split()), 3)
+            self.assertEqual(done, range(4, 30, 4) + [30])
+            self.keys['nokeys'] = [self.pubkey]
+            self.assert_(all(sigbatch.check_signatures(signed, self.keys)))
+
+    def test_shared_pool(self):
+        sigbatch.start_pool(2)
+        try:
+            self.assertEqual(sigbatch.check_signatures(self.rows, self.keys,
+                chunk_size=4, stop_on_failure=True), [True] * 17 + [False])
+            pool = sigbatch._pool
+            rows = [r[:5] for r in self.rows]
+            signed = list(sigbatch.sign_rows(rows, self.privkey,
+                chunk_size=4))
+            self.assertEqual(len(signed), 30)
+            self.assert_(all(sigbatch.check_signatures(signed[:20],
+                self.keys, chunk_size=4)))
+            self.assert_(sigbatch._pool is pool)
+        finally:
+            sigbatch.stop_pool()
+        self.assertEqual(sigbatch._pool, None)
+
+    def test_memo(self):
+        db = database.Database(':memory:', fill_example=False)
+        db.create_db()
+        checked = []
+        real = sigbatch._check
+        def count(rows, *args):
+            checked.extend(rows)
+            return real(rows, *args)
+        sigbatch._check = count
+        try:
+            first = sigbatch.check_signatures(self.rows, self.keys, memo=db)
+            self.assertEqual(len(checked), 30)
+            del checked[:]
+            again = sigbatch.check_signatures(self.rows, self.keys,
+                    stop_on_failure=True, memo=db)
+            # only the invalid rows are checked again
+            self.assertEqual(checked, [self.rows[17], self.rows[23]])
+            self.assertEqual(again, first[:18])
+            # new keys of the owner make the memo miss
+            del checked[:]
+            self.keys['freeconet'].append(self.pubkey.replace('\n', '\n\n'))
+            sigbatch.check_signatures(self.rows[:5], self.keys, memo=db)
+            self.assertEqual(len(checked), 5)
+        finally:
+            sigbatch._check = real
+
+    def test_memo_evict(self):
+        db = database.Database(':memory:', fill_example=False)
+        db.create_db()
+        db.verified_keep = 2
+        db.add_verified(['a', 'b'])
+        self.assertEqual(db.get_verified(['a']), set(['a']))
+        db.add_verified(['c'])
+        self.assertEqual(db.get_verified(['a', 'b', 'c']), set(['a', 'c']))
+        # lookups alone don't write
+        db.get_verified(['a'])
+        self.assertEqual(list(db.conn.execute(
+            "select digest from numbex_verified order by rowid")),
+            [('a',), ('c',)])
@@ -0,0 +1,57 @@
+from __future__ import absolute_import
+import unittest
+import os
+import tempfile
+
+from rangeindex import RangeIndex
+from snapshot import Snapshot, SnapshotError, write_snapshot
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(prefix='numbex-snap')
+        os.close(fd)
+        self.data = [('+481234', '+481299', '200 OK\nb\n'),
+                     ('+4820000', '+4820999', '200 OK\na\n'),
+                     ('+4830000', '+4830000', '')]
+        write_snapshot(self.path, RangeIndex(self.data), seq=42)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_find(self):
+        snap = Snapshot(self.path)
+        self.assertEqual(snap.seq, 42)
+        self.assertEqual(len(snap), 3)
+        for s, e, v in self.data:
+            self.assertEqual(snap.find(s), v)
+            self.assertEqual(snap.find(e), v)
+        self.assertEqual(snap.find('+481300'), None)
+        self.assertEqual(snap.find('+1'), None)
+        self.assertEqual(list(snap), list(RangeIndex(self.data)))
+
+    def test_patched(self):
+        snap = Snapshot(self.path)
+        new = snap.patched([('+4830000', '+4830000')],
+                [('+4830000', '+4830099', 'c')])
+        self.assert_(isinstance(new, RangeIndex))
+        self.assertEqual(new.find('+4830050'), 'c')
+        self.assertEqual(new.find('+481250'), '200 OK\nb\n')
+
+    def test_replace(self):
+        snap = Snapshot(self.path)
+        self.failIf(snap.changed())
+        write_snapshot(self.path, RangeIndex(), seq=43)
+        self.assert_(snap.changed())
+        # the old mapping stays usable
+        self.assertEqual(snap.find('+481250'), '200 OK\nb\n')
+        self.assertEqual(len(Snapshot(self.path)), 0)
+
+    def test_invalid(self):
+        f = file(self.path, 'wb')
+        f.write('not a snapshot, really not')
+        f.close()
+        self.assertRaises(SnapshotError, Snapshot, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
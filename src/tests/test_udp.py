@@ -3,12 +3,18 @@ import threading
 import signal
 import os
 import time
+import socket
 
 import database
 import subprocess
 
-from numbex_udp_server import serve_numbers_forever
-from numbex_udp_client import query_server, UDPServerException
+from numbex_udp_server import serve_numbers_forever, EventServer, Resolver
+from numbex_udp_server import make_reply, start_stream_server
+from rangeindex import RangeIndex
+from numbex_udp_client import query_server, query_many, UDPServerException
+from numbex_udp_client import Client, query_binary, query_stream
+from numbex_udp_client import MAX_DATAGRAM
+import wireproto
 
 
 class ServerProcess(object):
@@ -68,6 +74,19 @@ class TestUDPServer(unittest.TestCase):
         self.assertRaises(UDPServerException,
                 query_server, '+@!&#%&%$!@', 'localhost', port)
 
+    def test_udp_multi(self):
+        port = self.port
+        expected = '+481234,+481299,sip.freeconet.pl,freeconet'
+        # more than fits in a single reply
+        numbers = ['+481234', '+481300', 'tonienumer', '+481299'] * 20
+        result = query_many(numbers, 'localhost', port, timeout=5)
+        self.assertEqual(len(result), len(numbers))
+        for i in range(0, len(numbers), 4):
+            self.assertEqual(expected, result[i].rsplit(',', 2)[0])
+            self.assertEqual(None, result[i+1])
+            self.assert_(isinstance(result[i+2], UDPServerException))
+            self.assertEqual(expected, result[i+3].rsplit(',', 2)[0])
+
     def tearDown(self):
         self.srv.kill()
         # euthanize the server
@@ -77,6 +96,119 @@ class TestUDPServer(unittest.TestCase):
             pass
         
 
+class TestEventServer(unittest.TestCase):
+    def setUp(self):
+        self.ports = (58996, 58997)
+        self.r1 = ('+481234', '+481299', 'sip.freeconet.pl', 'freeconet',
+                '2009-01-03T23:59:30', 'sig')
+        self.r2 = ('+481234', '+481299', 'new.freeconet.pl', 'freeconet',
+                '2009-01-03T23:59:30', 'sig')
+        index = RangeIndex([(self.r1[0], self.r1[1], make_reply(self.r1))])
+        self.server = EventServer(Resolver(index), 'localhost', self.ports)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def test_ports(self):
+        expected = ','.join(self.r1)
+        for port in self.ports:
+            self.assertEqual(expected,
+                    query_server('+481250', 'localhost', port, timeout=5))
+            self.assertEqual(None,
+                    query_server('+481300', 'localhost', port, timeout=5))
+
+    def test_install(self):
+        self.assertEqual(None,
+                query_server('+481200', 'localhost', self.ports[0], timeout=5))
+        self.server.install(RangeIndex([('+481200', '+481299',
+            make_reply(self.r2))]))
+        time.sleep(0.1)
+        self.assertEqual(','.join(self.r2),
+                query_server('+481200', 'localhost', self.ports[0], timeout=5))
+
+    def test_client(self):
+        client = Client([('localhost', p) for p in self.ports], timeout=5)
+        expected = ','.join(self.r1)
+        self.assertEqual(expected, client.query('+481250'))
+        self.assertEqual(None, client.query('+481300'))
+        self.assertRaises(UDPServerException, client.query, 'tonienumer')
+        numbers = ['+481234', '+481300', 'tonienumer'] * 200
+        result = client.query_many(numbers, window=50)
+        for i in range(0, len(numbers), 3):
+            self.assertEqual(expected, result[i])
+            self.assertEqual(None, result[i+1])
+            self.assert_(isinstance(result[i+2], UDPServerException))
+        client.close()
+
+    def test_binary(self):
+        result = query_binary(['+481250', '+481300', 'tonienumer'] * 50,
+                'localhost', self.ports[0], timeout=5, flags=wireproto.SIGNATURE)
+        for i in range(0, 150, 3):
+            self.assertEqual(self.r1[:4] + (None, 'sig'), result[i])
+            self.assertEqual(None, result[i+1])
+            self.assert_(isinstance(result[i+2], UDPServerException))
+
+    def test_multi_tagged(self):
+        tag = '@' + 'f' * 100 + '\n'
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(5)
+        s.sendto(tag + 'MULTI\n' + '+481250\n' * 30,
+                ('localhost', self.ports[0]))
+        reply = s.recv(2 * MAX_DATAGRAM)
+        s.close()
+        self.assert_(len(reply) <= MAX_DATAGRAM, len(reply))
+        self.assert_(reply.startswith(tag))
+        lines = reply[len(tag):].splitlines()
+        self.assertEqual(lines[0], '210 OK %d' % (len(lines) - 1))
+        self.assertEqual(lines[1], '200 ' + ','.join(self.r1))
+        self.assert_(len(lines) - 1 < 30)
+
+    def test_stream(self):
+        stream = start_stream_server(self.server.resolver, 'localhost', 58996)
+        try:
+            numbers = ['+481250', '+481300', 'tonienumer'] * 20000
+            result = list(query_stream(numbers, 'localhost', 58996, 5))
+        finally:
+            stream.shutdown()
+            stream.server_close()
+        self.assertEqual(len(numbers), len(result))
+        for i in range(0, len(numbers), 3):
+            self.assertEqual(('+481250', ','.join(self.r1)), result[i])
+            self.assertEqual(('+481300', None), result[i+1])
+            self.assert_(isinstance(result[i+2][1], UDPServerException))
+
+    def test_client_retry(self):
+        # nothing listens on the first server
+        client = Client([('localhost', 58995), ('localhost', self.ports[0])],
+                timeout=0.2, retries=1, hedge=False, eject_after=1)
+        self.assertEqual(','.join(self.r1), client.query('+481250'))
+        self.assertEqual(1, client.counts['retried'])
+        self.assertEqual(1, client.counts['ejected'])
+        # the dead server is skipped now
+        self.assertEqual(','.join(self.r1), client.query('+481250'))
+        self.assertEqual(1, client.counts['retried'])
+        client.servers = client.servers[:1]
+        self.assertRaises(socket.timeout, client.query, '+481250')
+        self.assertEqual(1, client.counts['timeout'])
+        client.close()
+
+    def test_client_hedge(self):
+        client = Client([('localhost', 58995), ('localhost', self.ports[0])],
+                timeout=5)
+        dead = client.servers[0]
+        for i in range(client.min_samples):
+            client.stats[dead].add_rtt(0.01)
+        start = time.time()
+        self.assertEqual(','.join(self.r1), client.query('+481250'))
+        self.assert_(time.time() - start < 1)
+        self.assertEqual(1, client.counts['hedged'])
+        self.assertEqual(1, client.counts['hedge_won'])
+        self.assert_(len(client.stats[client.servers[1]].rtts) == 1)
+        client.close()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+
 
 if __name__ == '__main__':
     unittest.main()
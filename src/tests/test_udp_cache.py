@@ -0,0 +1,168 @@
+from __future__ import absolute_import
+import unittest
+import socket
+import threading
+import time
+
+from numbex_udp_cache import CachingResolver, CacheServer, invalidate
+from numbex_udp_client import Client, UDPServerException
+
+class FakeClient(object):
+    '''answers queries when told to'''
+    timeout = 1.0
+    events = []
+
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, number, callback):
+        self.submitted.append((number, callback))
+
+    def answer(self, result):
+        number, callback = self.submitted.pop(0)
+        callback(number, result)
+
+
+class TestCachingResolver(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.resolver = CachingResolver(self.client, size=10, ttl=0.2,
+                negative_ttl=0.2, refresh=0.5, popular=2)
+        self.replies = []
+
+    def lookup(self, number):
+        self.resolver.lookup(number, self.replies.append)
+
+    def test_hit(self):
+        self.lookup('+481234')
+        self.lookup('+481234')
+        self.assertEqual(1, len(self.client.submitted))
+        self.client.answer('rec')
+        self.assertEqual(['200 OK\nrec\n'] * 2, self.replies)
+        self.lookup('+481234')
+        self.assertEqual(0, len(self.client.submitted))
+        self.assertEqual(3, len(self.replies))
+        self.assertEqual(1, self.resolver.counts['hit'])
+
+    def test_negative(self):
+        self.lookup('+4899')
+        self.client.answer(None)
+        self.lookup('abc')
+        self.client.answer(UDPServerException('500 invalid number\n'))
+        self.lookup('+4899')
+        self.lookup('abc')
+        self.assertEqual(['404 Not found\n', '500 invalid number\n'] * 2,
+                self.replies)
+
+    def test_expiry_and_refresh(self):
+        self.lookup('+481234')
+        self.client.answer('old')
+        self.lookup('+481234')
+        time.sleep(0.12)
+        # popular and past the refresh point, served but fetched again
+        self.lookup('+481234')
+        self.assertEqual(1, len(self.client.submitted))
+        self.client.answer('new')
+        self.lookup('+481234')
+        self.assertEqual('200 OK\nnew\n', self.replies[-1])
+        time.sleep(0.25)
+        self.lookup('+481234')
+        self.assertEqual(1, len(self.client.submitted))
+
+    def test_timeout(self):
+        self.lookup('+481234')
+        self.client.answer(socket.timeout())
+        self.assertEqual(['503 Upstream not responding\n'], self.replies)
+        self.lookup('+481234')
+        self.assertEqual(1, len(self.client.submitted))
+
+    def test_invalidate(self):
+        for n in ('+481234', '+481300', 'abc'):
+            self.lookup(n)
+            self.client.answer(None)
+        self.resolver.invalidate([('+481200', '+481299')])
+        self.assertEqual(['abc', '+481300'], self.resolver.cache.keys())
+        # an answer fetched before invalidation is not cached
+        self.lookup('+481234')
+        self.resolver.invalidate([('+481200', '+481299')])
+        self.client.answer('stale')
+        self.assert_('+481234' not in self.resolver.cache)
+        self.resolver.invalidate()
+        self.assertEqual(0, len(self.resolver.cache))
+
+
+class TestCacheServer(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.client.poll = lambda timeout: 0
+        self.client.close = lambda: None
+        self.client.fileno = lambda: self.upstream.fileno()
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.resolver = CachingResolver(self.client)
+        self.resolver._fetched('+481234', 'rec', 0)
+        self.resolver._fetched('+4899', None, 0)
+        self.server = CacheServer(self.resolver, 'localhost', 58994)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def test_protocol(self):
+        client = Client([('localhost', 58994)], timeout=5)
+        self.assertEqual('rec', client.query('+481234'))
+        self.assertEqual(None, client.query('+4899'))
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.settimeout(5)
+        s.sendto('MULTI\n+481234\n+4899\n', ('localhost', 58994))
+        self.assertEqual('210 OK 2\n200 rec\n404 +4899\n', s.recv(1400))
+        invalidate([('localhost', 58994)], [('+481200', '+481299')])
+        s.sendto('+4899', ('localhost', 58994))
+        s.recv(1400)
+        self.assertEqual(['+4899'], self.resolver.cache.keys())
+        s.close()
+        client.close()
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.upstream.close()
+
+
+class TestCacheServerHedge(unittest.TestCase):
+    def setUp(self):
+        # two upstreams never answering
+        self.upstreams = []
+        for port in (58995, 58996):
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.bind(('127.0.0.1', port))
+            self.upstreams.append(s)
+        self.client = Client([('127.0.0.1', 58995), ('127.0.0.1', 58996)],
+                timeout=2.0)
+        for stats in self.client.stats.values():
+            for i in xrange(Client.min_samples):
+                stats.add_rtt(0.05)
+        self.server = CacheServer(CachingResolver(self.client), 'localhost',
+                58994)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def test_hedge_delay(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.sendto('+481234', ('localhost', 58994))
+        s.close()
+        times = []
+        for upstream in self.upstreams:
+            upstream.settimeout(1.0)
+            upstream.recv(1400)
+            times.append(time.time())
+        # hedged after the 0.05 s p95, not the 2 s timeout
+        self.assert_(times[1] - times[0] < 0.5, times)
+        self.assertEqual(1, self.client.counts['hedged'])
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        for s in self.upstreams:
+            s.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
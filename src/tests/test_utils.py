@@ -17,5 +17,34 @@ class TestParseIsoDate(unittest.TestCase):
         x = '2009-02-02T02:02:02.002222'
         self.assertEqual(f(x), y)
 
+class TestLRUCache(unittest.TestCase):
+    def test_eviction(self):
+        c = utils.LRUCache(3)
+        for i in range(3):
+            c.put(i, str(i))
+        self.assertEqual(c.get(0), '0')
+        c.put(3, '3')
+        self.assertEqual(len(c), 3)
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(c.keys(), [3, 0, 2])
+        c.put(2, 'two')
+        self.assertEqual(c.keys(), [2, 3, 0])
+        self.assertEqual(c.pop(3), '3')
+        self.assertEqual(c.keys(), [2, 0])
+
+    def test_disabled(self):
+        c = utils.LRUCache(0)
+        c.put(1, 1)
+        self.assertEqual(c.get(1), None)
+        self.assertEqual(len(c), 0)
+
+    def test_clear(self):
+        c = utils.LRUCache(2)
+        c.put(1, 1)
+        c.clear()
+        self.assertEqual(c.keys(), [])
+        c.put(2, 2)
+        self.assertEqual(c.get(2), 2)
+
 if __name__ == '__main__':
     unittest.main()
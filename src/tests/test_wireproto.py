@@ -0,0 +1,60 @@
+from __future__ import absolute_import
+import unittest
+import datetime
+
+import wireproto
+from wireproto import encode_request, decode_request, encode_response, \
+        decode_response, HIT, MISS, MALFORMED, DATE, SIGNATURE
+
+class TestWireProto(unittest.TestCase):
+    def setUp(self):
+        self.r1 = ('+481234', '+481299', 'sip.freeconet.pl', 'freeconet',
+                '2009-01-03T23:59:30.123456', 'sig1')
+        self.r2 = ('+4820000', '+4820999', 'sip.freeconet.pl', 'freeconet',
+                '2009-01-03T23:59:30', 'sig2')
+
+    def test_request(self):
+        request, count = encode_request(7, [481234, 4820000], DATE)
+        self.assertEqual(2, count)
+        self.assert_(wireproto.is_binary(request))
+        self.assertEqual((1, DATE, 7, [481234, 4820000]),
+                decode_request(request))
+        request, count = encode_request(7, range(1, 1000))
+        self.assert_(len(request) <= wireproto.MAX_DATAGRAM)
+        self.assertEqual(count, len(decode_request(request)[3]))
+        self.assertRaises(wireproto.WireError, decode_request, request[:-1])
+
+    def test_response(self):
+        entries = [(HIT, self.r1), (MISS, None), (MALFORMED, None),
+                (HIT, self.r2)]
+        reply, count = encode_response(9, entries, DATE|SIGNATURE)
+        self.assertEqual(4, count)
+        # both records share the sip and owner strings
+        self.assertEqual(1, reply.count('sip.freeconet.pl'))
+        status, version, flags, rid, decoded = decode_response(reply)
+        self.assertEqual((wireproto.OK, 1, DATE|SIGNATURE, 9),
+                (status, version, flags, rid))
+        self.assertEqual([(HIT, self.r1[:4] + (
+                datetime.datetime(2009, 1, 3, 23, 59, 30, 123456), 'sig1')),
+            (MISS, None), (MALFORMED, None),
+            (HIT, self.r2[:4] + (datetime.datetime(2009, 1, 3, 23, 59, 30),
+                'sig2'))], decoded)
+        reply, count = encode_response(9, entries)
+        self.assertEqual((HIT, self.r1[:4] + (None, None)),
+                decode_response(reply)[4][0])
+
+    def test_truncated(self):
+        reply, count = encode_response(1, [(HIT, self.r1)] * 100, SIGNATURE)
+        self.assert_(count < 100)
+        self.assert_(len(reply) <= wireproto.MAX_DATAGRAM)
+        self.assertEqual(count, len(decode_response(reply)[4]))
+        self.assertRaises(wireproto.WireError, decode_response, reply[:30])
+
+    def test_numbers(self):
+        self.assertEqual(481234, wireproto.encode_number('+481234'))
+        self.assertRaises(ValueError, wireproto.encode_number, 'abc')
+        self.assertRaises(ValueError, wireproto.encode_number, '+0123')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,3 +28,76 @@ def parse_csv_data(datastream):
         ret.append(row)
     return ret
     
+
+
+class LRUCache(object):
+    '''bounded mapping that forgets the least recently used entries'''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = {}
+        # circular doubly linked list of [prev, next, key, value],
+        # most recently used first
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _push(self, link):
+        root = self.root
+        first = root[1]
+        link[0], link[1] = root, first
+        first[0] = root[1] = link
+
+    def get(self, key, default=None):
+        link = self.data.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._push(link)
+        return link[3]
+
+    def put(self, key, value):
+        link = self.data.get(key)
+        if link is not None:
+            link[3] = value
+            self._unlink(link)
+            self._push(link)
+            return
+        if self.maxsize <= 0:
+            return
+        if len(self.data) >= self.maxsize:
+            last = self.root[0]
+            self._unlink(last)
+            del self.data[last[2]]
+        link = [None, None, key, value]
+        self._push(link)
+        self.data[key] = link
+
+    def pop(self, key, default=None):
+        link = self.data.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        return link[3]
+
+    def clear(self):
+        self.data.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
+    def keys(self):
+        '''keys, most recently used first'''
+        ret = []
+        link = self.root[1]
+        while link is not self.root:
+            ret.append(link[2])
+            link = link[1]
+        return ret
@@ -0,0 +1,188 @@
+'''binary form of the UDP lookup protocol.
+
+A binary datagram starts with MAGIC, which never starts a text request,
+followed by the protocol version; everything is in network byte order.
+
+request:  magic B, version B, flags B, pad x, id I, count H,
+          count numbers Q (digits of the E.164 number)
+response: magic B, version B, flags B, status B, id I, count H,
+          string count H, strings (length H, bytes),
+          count entries: kind B, for HIT also start Q, end Q,
+          sip H, owner H (indexes into the strings), date q (with
+          DATE, microseconds since the epoch), signature (with SIGNATURE,
+          length H, bytes)
+
+flags select the optional fields.  Like MULTI, a response answers only
+as many numbers as fit in MAX_DATAGRAM, count tells how many.  A server
+not speaking the requested version answers with status BAD_VERSION and
+its own version, one refusing the request for now with status BUSY.
+'''
+import struct
+import datetime
+
+MAGIC = 0xb1
+VERSION = 1
+MAX_DATAGRAM = 1400
+
+# flags
+DATE = 1
+SIGNATURE = 2
+
+# response status
+OK = 0
+BAD_VERSION = 1
+BUSY = 2
+
+# entry kinds
+HIT = 0
+MISS = 1
+MALFORMED = 2
+
+_request = struct.Struct('!BBBxIH')
+_response = struct.Struct('!BBBBIHH')
+_hit = struct.Struct('!BQQHH')
+_kind = struct.Struct('!B')
+_short = struct.Struct('!H')
+_date = struct.Struct('!q')
+
+class WireError(Exception):
+    def __init__(self, *args, **kwargs):
+        Exception.__init__(self, *args, **kwargs)
+
+
+def is_binary(message):
+    return message[:1] == chr(MAGIC)
+
+def encode_number(number):
+    '''"+48123" -> 48123; raises ValueError for anything but digits'''
+    digits = str(number).strip().lstrip('+')
+    if not digits.isdigit() or digits[0] == '0':
+        raise ValueError('invalid number: %r' % number)
+    return int(digits)
+
+_epoch = datetime.datetime(1970, 1, 1)
+
+def encode_date(d):
+    '''datetime or ISO string -> microseconds since the epoch'''
+    if isinstance(d, basestring):
+        # strptime is an order of magnitude slower
+        us = 0
+        if len(d) > 20:
+            us = int(d[20:26].ljust(6, '0'))
+        d = datetime.datetime(int(d[0:4]), int(d[5:7]), int(d[8:10]),
+                int(d[11:13]), int(d[14:16]), int(d[17:19]), us)
+    d = d - _epoch
+    return (d.days * 86400 + d.seconds) * 1000000 + d.microseconds
+
+def decode_date(us):
+    return _epoch + datetime.timedelta(microseconds=us)
+
+def encode_request(rid, numbers, flags=0):
+    '''numbers are ints, see encode_number; at most as many as fit in a
+datagram are encoded, returns the request and their count'''
+    count = min(len(numbers), (MAX_DATAGRAM - _request.size) // 8)
+    return _request.pack(MAGIC, VERSION, flags, rid, count) + \
+            struct.pack('!%dQ' % count, *numbers[:count]), count
+
+def peek_request(message):
+    '''returns the (id, count) of a request without decoding it'''
+    if len(message) < _request.size:
+        raise WireError('short request')
+    return _request.unpack_from(message)[3:]
+
+def decode_request(message):
+    '''returns (version, flags, id, numbers)'''
+    if len(message) < _request.size:
+        raise WireError('short request')
+    magic, version, flags, rid, count = _request.unpack_from(message)
+    if version != VERSION:
+        return version, flags, rid, []
+    if len(message) != _request.size + 8*count:
+        raise WireError('bad request length')
+    return version, flags, rid, \
+            list(struct.unpack_from('!%dQ' % count, message, _request.size))
+
+def encode_error(rid, status, flags=0):
+    return _response.pack(MAGIC, VERSION, flags, status, rid, 0, 0)
+
+def encode_response(rid, entries, flags=0):
+    '''entries: (kind, record) pairs, record is the (start, end, sip,
+owner, date, signature) of a hit and ignored otherwise.  Returns the
+response and the number of entries in it.'''
+    strings = {}
+    table = []
+    body = []
+    size = _response.size
+    count = 0
+    for kind, r in entries:
+        if kind != HIT:
+            part = _kind.pack(kind)
+            new = ()
+        else:
+            new = [s for s in (r[2], r[3]) if s not in strings]
+            if len(new) == 2 and new[0] == new[1]:
+                new = new[:1]
+            parts = []
+            ids = []
+            for s in (r[2], r[3]):
+                i = strings.get(s)
+                if i is None:
+                    i = len(table) + new.index(s)
+                ids.append(i)
+            parts.append(_hit.pack(kind, encode_number(r[0]),
+                encode_number(r[1]), ids[0], ids[1]))
+            if flags & DATE:
+                parts.append(_date.pack(encode_date(r[4])))
+            if flags & SIGNATURE:
+                parts.append(_short.pack(len(r[5])) + r[5])
+            part = ''.join(parts)
+        extra = len(part) + sum(2 + len(s) for s in new)
+        if size + extra > MAX_DATAGRAM:
+            break
+        size += extra
+        for s in new:
+            strings[s] = len(table)
+            table.append(s)
+        body.append(part)
+        count += 1
+    head = _response.pack(MAGIC, VERSION, flags, OK, rid, count, len(table))
+    return head + ''.join(_short.pack(len(s)) + s for s in table) + \
+            ''.join(body), count
+
+def decode_response(message):
+    '''returns (status, version, flags, id, entries), entries are (kind,
+record) pairs with records like in encode_response: numbers as "+..."
+strings, the date a datetime, optional fields None when not sent'''
+    try:
+        magic, version, flags, status, rid, count, nstrings = \
+                _response.unpack_from(message)
+        if magic != MAGIC:
+            raise WireError('not a binary response')
+        off = _response.size
+        table = []
+        for i in xrange(nstrings):
+            n = _short.unpack_from(message, off)[0]
+            table.append(message[off+2:off+2+n])
+            off += 2 + n
+        entries = []
+        for i in xrange(count):
+            kind = _kind.unpack_from(message, off)[0]
+            if kind != HIT:
+                entries.append((kind, None))
+                off += 1
+                continue
+            kind, start, end, sip, owner = _hit.unpack_from(message, off)
+            off += _hit.size
+            date = signature = None
+            if flags & DATE:
+                date = decode_date(_date.unpack_from(message, off)[0])
+                off += 8
+            if flags & SIGNATURE:
+                n = _short.unpack_from(message, off)[0]
+                signature = message[off+2:off+2+n]
+                off += 2 + n
+            entries.append((HIT, ('+%d' % start, '+%d' % end, table[sip],
+                table[owner], date, signature)))
+    except (struct.error, IndexError), e:
+        raise WireError('bad response: %s' % e)
+    return status, version, flags, rid, entries